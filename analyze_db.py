@@ -2,7 +2,9 @@ import sqlite3
 import os
 from pathlib import Path
 
-def analyze_database():
+from memory.db import decompress_metadata
+
+def analyze_database(use_counts_table=True):
     db_path = Path('mymemory/.memory/metadata.db')
     if not db_path.exists():
         print("Database not found!")
@@ -11,15 +13,14 @@ def analyze_database():
     print(f"Database file size: {db_path.stat().st_size / (1024*1024):.2f} MB")
     
     conn = sqlite3.connect(db_path)
+    # Metadata is stored compressed, the metadata analysis looks at the decompressed JSON
+    conn.create_function('decompress_metadata', 1, decompress_metadata, deterministic=True)
     cursor = conn.cursor()
+    # Bigger page cache and mmap'd reads, the whole analysis is read-only
+    cursor.execute('PRAGMA query_only=1')
+    cursor.execute('PRAGMA cache_size=-65536')
+    cursor.execute('PRAGMA mmap_size=268435456')
     
-    # Get total rows
-    cursor.execute('SELECT COUNT(*) FROM files')
-    total_rows = cursor.fetchone()[0]
-    print(f"Total rows: {total_rows}")
-    
-    # Analyze column sizes
-    print("\nColumn analysis:")
     columns = [
         'file_hash', 'original_filename', 'current_filename', 
         'original_path', 'current_path', 'size', 'media_type', 
@@ -27,55 +28,99 @@ def analyze_database():
         'uploaded_gcloud', 'uploaded_azure', 'metadata_extracted', 
         'perceptual_hash'
     ]
+    # Older/newer schemas may lack some columns, only analyze what is there
+    cursor.execute('PRAGMA table_info(files)')
+    existing_columns = {row[1] for row in cursor.fetchall()}
+    columns = [col for col in columns if col in existing_columns]
+    
+    # The row count is maintained by triggers in _counts; databases created
+    # before that table existed fall back to COUNT(*) in the same pass
+    if use_counts_table:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = '_counts'")
+        use_counts_table = cursor.fetchone() is not None
     
+    # Gather every statistic in a single pass over the table instead of
+    # issuing separate full scans per column / per check
+    select_exprs = ['NULL' if use_counts_table else 'COUNT(*)']
     for col in columns:
-        cursor.execute(f'SELECT AVG(LENGTH({col})) FROM files WHERE {col} IS NOT NULL')
-        avg_len = cursor.fetchone()[0] or 0
-        cursor.execute(f'SELECT COUNT(*) FROM files WHERE {col} IS NOT NULL')
-        non_null_count = cursor.fetchone()[0]
+        select_exprs.append(f'AVG(LENGTH({col}))')
+        select_exprs.append(f'COUNT({col})')
+    has_metadata = 'extracted_metadata' in existing_columns
+    has_orig_filename = 'original_filename' in existing_columns
+    # meta_len holds the uncompressed JSON size, so nothing has to be
+    # decompressed; older databases compute it from the blobs. Anything up
+    # to 2 bytes is an empty '{}'.
+    meta_len_expr = 'meta_len' if 'meta_len' in existing_columns else 'LENGTH(decompress_metadata(extracted_metadata))'
+    select_exprs.append(
+        f"SUM(extracted_metadata IS NULL OR {meta_len_expr} <= 2)" if has_metadata else 'NULL')
+    select_exprs.append(
+        f"SUM(CASE WHEN {meta_len_expr} > 2 THEN {meta_len_expr} END)" if has_metadata else 'NULL')
+    select_exprs.append(
+        "SUM(original_filename = ''), SUM(original_filename IS NULL)" if has_orig_filename else 'NULL, NULL')
+    cursor.execute(f"SELECT {', '.join(select_exprs)} FROM files")
+    row = cursor.fetchone()
+    
+    if use_counts_table:
+        cursor.execute("SELECT n FROM _counts WHERE table_name = 'files'")
+        total_rows = cursor.fetchone()[0]
+    else:
+        total_rows = row[0]
+    print(f"Total rows: {total_rows}")
+    
+    # Analyze column sizes
+    print("\nColumn analysis:")
+    column_stats = {}
+    for i, col in enumerate(columns):
+        avg_len = row[1 + 2 * i] or 0
+        non_null_count = row[2 + 2 * i]
+        column_stats[col] = (avg_len, non_null_count)
         total_size = avg_len * non_null_count
         print(f"  {col}: avg {avg_len:.1f} chars, {non_null_count} non-null, est. {total_size/1024:.1f} KB")
+    empty_meta, total_meta_size, empty_orig_filename, null_orig_filename = row[1 + 2 * len(columns):]
     
     # Analyze metadata specifically
-    print("\nMetadata analysis:")
-    cursor.execute('SELECT LENGTH(extracted_metadata) as meta_len, COUNT(*) as count FROM files WHERE extracted_metadata IS NOT NULL AND extracted_metadata != "{}" GROUP BY meta_len ORDER BY meta_len DESC LIMIT 10')
-    meta_dist = cursor.fetchall()
-    print("  Non-empty metadata size distribution:")
-    for meta_len, count in meta_dist:
-        print(f"    {meta_len} chars: {count} files")
-    
-    cursor.execute('SELECT COUNT(*) FROM files WHERE extracted_metadata = "{}" OR extracted_metadata IS NULL')
-    empty_meta = cursor.fetchone()[0]
-    print(f"  Empty metadata: {empty_meta} files")
+    if has_metadata:
+        print("\nMetadata analysis:")
+        cursor.execute(f'''
+            WITH meta AS (
+                SELECT {meta_len_expr} AS meta_len FROM files
+                WHERE extracted_metadata IS NOT NULL
+            )
+            SELECT meta_len, COUNT(*) AS count FROM meta WHERE meta_len > 2
+            GROUP BY meta_len ORDER BY meta_len DESC LIMIT 10
+        ''')
+        meta_dist = cursor.fetchall()
+        print("  Non-empty metadata size distribution:")
+        for meta_len, count in meta_dist:
+            print(f"    {meta_len} bytes: {count} files")
+        print(f"  Empty metadata: {empty_meta or 0} files")
     
     # Analyze path lengths
     print("\nPath analysis:")
-    cursor.execute('SELECT AVG(LENGTH(original_path)), AVG(LENGTH(current_path)) FROM files')
-    orig_avg, curr_avg = cursor.fetchone()
-    print(f"  Average original_path length: {orig_avg:.1f} chars")
-    print(f"  Average current_path length: {curr_avg:.1f} chars")
+    for col in ('original_path', 'current_path'):
+        if col in column_stats:
+            print(f"  Average {col} length: {column_stats[col][0]:.1f} chars")
     
     # Check for potential optimizations
     print("\nOptimization opportunities:")
     
-    # Check if original_filename is mostly empty
-    cursor.execute('SELECT COUNT(*) FROM files WHERE original_filename IS NULL OR original_filename = ""')
-    empty_orig_filename = cursor.fetchone()[0]
-    if empty_orig_filename > 0:
+    # Check if original_filename is mostly empty. NULL is already as small as
+    # it gets: never recorded (import doesn't), or cleared by migrate because
+    # it matched current_filename.
+    if empty_orig_filename:
         print(f"  - {empty_orig_filename} files have empty original_filename (can be dropped)")
+    if null_orig_filename:
+        print(f"  - {null_orig_filename} files store no original_filename")
     
-    # Check metadata compression potential
-    cursor.execute('SELECT SUM(LENGTH(extracted_metadata)) FROM files WHERE extracted_metadata IS NOT NULL AND extracted_metadata != "{}"')
-    total_meta_size = cursor.fetchone()[0] or 0
-    if total_meta_size > 0:
-        print(f"  - Metadata takes ~{total_meta_size/1024:.1f} KB (could be compressed)")
+    # Check how much raw metadata there is
+    if total_meta_size:
+        print(f"  - Metadata is ~{total_meta_size/1024:.1f} KB uncompressed")
     
     # Check perceptual hash usage
-    cursor.execute('SELECT COUNT(*) FROM files WHERE perceptual_hash IS NOT NULL')
-    phash_count = cursor.fetchone()[0]
+    phash_count = column_stats.get('perceptual_hash', (0, 0))[1]
     print(f"  - {phash_count} files have perceptual hashes")
     
     conn.close()
 
 if __name__ == "__main__":
-    analyze_database() 
\ No newline at end of file
+    analyze_database()
@@ -28,7 +28,8 @@ def import_cmd(source_folder, recursive, threads):
 @cli.command()
 @click.option('--dryrun', is_flag=True, help="List files that would be uploaded without performing the upload.")
 @click.argument('cloud_target', required=False, type=click.Choice(['s3', 'gcloud', 'azure']))
-def upload(dryrun, cloud_target):
+@click.option('--threads', default=8, show_default=True, type=int, help='Number of concurrent uploads (default: 8)')
+def upload(dryrun, cloud_target, threads):
     """
     Uploads new files to cloud storage.
     Specify 's3', 'gcloud', or 'azure' as the target.
@@ -38,7 +39,7 @@ def upload(dryrun, cloud_target):
             click.echo(f"Warning: --dryrun option ignores the cloud_target '{cloud_target}'. Listing all unuploaded files.")
         core.upload_dry_run()
     elif cloud_target:
-        core.upload_to_cloud(cloud_target)
+        core.upload_to_cloud(cloud_target, threads=threads)
     else:
         click.echo("Error: Please specify a cloud target (s3, gcloud, azure) or use --dryrun.")
         click.echo("Usage: memory upload [--dryrun] <cloud_target>")
@@ -94,11 +95,12 @@ def migrate():
 
 @cli.command()
 @click.argument('folder', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True))
-def scan(folder):
+@click.option('--threads', default=4, show_default=True, type=int, help='Number of threads used to hash candidate files (default: 4)')
+def scan(folder, threads):
     """
     Scan the specified folder for files not under management and print stats by total number, total size, and by extension.
     """
-    core.scan_unmanaged_files(folder)
+    core.scan_unmanaged_files(folder, threads=threads)
 
 if __name__ == '__main__':
     cli()
@@ -6,19 +6,25 @@ from pathlib import Path
 from typing import Optional, List, Dict, Any
 import sys
 import logging
-import urllib.parse
 from PIL import Image
 import imagehash
 import cv2
 import concurrent.futures
+import itertools
 import signal
 
-from memory.db import MemoryDB, DB_NAME
-from memory.hasher import calculate_file_hash
-from memory.utils import generate_timestamp_suffix, get_media_type, is_valid_media_file
+from memory.db import get_db, close_db, DB_NAME, compress_metadata, decompress_metadata, backfill_meta_len, backfill_perceptual_hash_int, phash_to_int
+from memory.hasher import calculate_file_hash, files_have_same_content
+from memory.utils import generate_timestamp_suffix, get_media_type, get_media_type_by_name, is_valid_media_file, fast_copy, BatchedOutput, iter_files, file_ext
 from memory.media import get_media_metadata # Ensure this is imported
+from memory.phash_index import BKTree, DisjointSet
 
 MEMORY_FOLDER_NAME = ".memory"
+INSERT_BATCH_SIZE = 256 # Files inserted per database transaction during import
+FILES_QUEUED_PER_THREAD = 4 # Files submitted ahead per import thread
+UPLOADS_QUEUED_PER_THREAD = 2 # Uploads submitted ahead per upload thread
+PHASH_CHUNK_SIZE = 16 # Files sent to a perceptual hash worker process at a time
+PHASH_DRAFT_SIZE = (256, 256) # Smallest size a JPEG is decoded at for its pHash (see Image.draft)
 
 def _get_home_folder_path() -> Path:
     return Path.cwd()
@@ -43,22 +49,68 @@ def init_memory():
     memory_path.mkdir(parents=True, exist_ok=True)
     print(f"Created '{memory_path}'.")
 
-    db = MemoryDB(db_path)
     try:
-        db.connect()
+        get_db(db_path)
         print(f"Initialized database at '{db_path}'.")
     except Exception as e:
         print(f"Error initializing database: {e}")
+        close_db(db_path)
         shutil.rmtree(memory_path) # Clean up on error
         return False
-    finally:
-        db.close()
 
     print("Scanning current folder for media files...")
     _scan_and_process_folder(home_folder, db_path, is_init=True)
     print("Memory initialization complete.")
     return True
 
+def _iter_completed(executor, fn, items, max_pending: int, stop_event):
+    """
+    Submits fn(*args) to executor for each args tuple in items and yields
+    (args, future) as they complete, keeping at most max_pending submitted
+    but unfinished. items is consumed lazily from the calling thread, so it
+    can be a generator such as a directory walk. Once stop_event is set
+    nothing new is submitted; work already submitted still completes.
+    """
+    items = iter(items)
+    pending = {}
+    def submit_next():
+        if stop_event.is_set():
+            return False
+        args = next(items, None)
+        if args is None:
+            return False
+        pending[executor.submit(fn, *args)] = args
+        return True
+
+    for _ in range(max_pending):
+        if not submit_next():
+            break
+    while pending:
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            args = pending.pop(future)
+            submit_next()
+            yield args, future
+
+def _cached_file_hash(db, filepath: Path, st, new_entries: list) -> str:
+    """
+    Returns the SHA-256 of a file outside .memory, from hash_cache when the
+    file's size, mtime and inode are unchanged. Fresh hashes are appended to
+    new_entries for the caller to write with db.cache_hashes.
+    """
+    key = str(filepath)
+    file_hash = db.get_cached_hash(key, st.st_mtime_ns, st.st_size, st.st_ino)
+    if file_hash is None:
+        file_hash = calculate_file_hash(filepath)
+        new_entries.append((key, st.st_mtime_ns, st.st_size, st.st_ino, file_hash))
+    return file_hash
+
+def _flush_cached_hashes(db, new_entries: list):
+    """Writes the entries collected by _cached_file_hash; workers may still be appending."""
+    entries = new_entries[:]
+    del new_entries[:len(entries)]
+    db.cache_hashes(entries)
+
 def _scan_and_process_folder(
     source_folder: Path,
     db_path: Path,
@@ -73,79 +125,102 @@ def _scan_and_process_folder(
     Uses a thread pool for parallel file processing, with real-time progress reporting.
     Handles KeyboardInterrupt for safe shutdown.
     """
-    import itertools
     import threading
-    import queue
     stop_event = threading.Event()
-    db = MemoryDB(db_path)
-    db.connect()
+    db = get_db(db_path)
     try:
-        managed_hashes = set(db.get_all_file_hashes())
+        # Hashes and .memory file names claimed by workers during this run.
+        # Workers claim them under claim_lock before copying, so two files with
+        # the same content (or the same name) can't both be copied in parallel.
+        # Anything older is checked against the database's indexes instead of
+        # loading every managed hash into memory up front.
+        claim_lock = threading.Lock()
+        claimed_hashes = set() # Raw digests
+        claimed_names = set()
         new_files_processed = 0
         memory_path = _get_memory_path()
-        if recursive:
-            file_iter = list(source_folder.rglob('*'))
-        else:
-            file_iter = list(source_folder.iterdir())
-        files_to_process = [f for f in file_iter if f.is_file() and MEMORY_FOLDER_NAME not in f.parts]
-        total_files = len(files_to_process)
+        # (path, stat) pairs, so the stat taken during discovery is reused later.
+        # .memory folders are pruned during the walk rather than checked per file,
+        # and other files are dropped by extension before they are stat'ed.
+        def is_media_name(name):
+            if get_media_type_by_name(name):
+                return True
+            if logger: logger.info(f"Skipping '{name}': Not a media file.")
+            return False
+        # Streamed straight into the thread pool: processing starts with the
+        # first file found, and the tree is never held in memory as a list
+        files_to_process = iter_files(
+            source_folder, frozenset({MEMORY_FOLDER_NAME}), recursive=recursive, name_filter=is_media_name
+        )
+        # Paths found by the walk; once it completes, hash_cache entries for
+        # anything else under source_folder are dropped
+        seen_paths = set()
+        def walk():
+            for filepath, st in files_to_process:
+                seen_paths.add(str(filepath))
+                yield filepath, st
         processed_files = 0
 
-        def process_file(filepath):
-            nonlocal managed_hashes
-            if stop_event.is_set():
-                return None
-            media_type = get_media_type(filepath)
-            if not media_type:
-                if logger: logger.info(f"Skipping '{filepath.name}': Not a media file.")
-                return None
-            
-            # Validate file integrity before processing
-            if not is_valid_media_file(filepath):
-                msg = f"Skipping '{filepath.name}': Invalid or corrupted file (failed header check)."
-                if logger: logger.info(msg)
-                return None
-            
-            file_hash = calculate_file_hash(filepath)
-            if file_hash in managed_hashes:
-                msg = f"Skipping '{filepath.name}': Duplicate file (hash: {file_hash})."
-                if logger: logger.info(msg)
-                return None
+        hashed = [] # Source files hashed during this run, for hash_cache
+        # (st_mtime_ns, hash) of files in .memory hashed during this run, for
+        # destinations that are hit again by files with the same name
+        dest_hashes = {}
+        def _existing_file_hash(dest_path):
+            # Files already managed have their hash on record; only files not
+            # (yet) in the database have to be read
+            file_hash = db.get_hash_by_current_path(_to_relative_path(dest_path, memory_path))
+            if file_hash:
+                return file_hash
+            mtime_ns = dest_path.stat().st_mtime_ns
+            cached = dest_hashes.get(dest_path)
+            if cached and cached[0] == mtime_ns:
+                return cached[1]
+            file_hash = calculate_file_hash(dest_path)
+            dest_hashes[dest_path] = (mtime_ns, file_hash)
+            return file_hash
+
+        def copy_file(filepath, st, media_type, file_hash):
             # Always copy into .memory folder
             dest_folder = memory_path
             current_filename = filepath.name
             dest_path = dest_folder / current_filename
-            # Only apply filename suffix if the destination file already exists AND it's not the same content
-            if dest_path.exists():
-                existing_file_hash = calculate_file_hash(dest_path)
+            with claim_lock:
+                name_taken = current_filename in claimed_names
+                claimed_names.add(current_filename)
+            # Only apply filename suffix if the destination file already exists AND it's not the same content.
+            # A name claimed earlier in this run always holds different content, its hash was claimed too.
+            if not name_taken and dest_path.exists():
+                existing_file_hash = _existing_file_hash(dest_path)
                 if existing_file_hash == file_hash:
                     msg = f"Skipping '{filepath.name}': Already present as '{dest_path.name}'."
                     if logger: logger.info(msg)
                     return None # File already exists in .memory folder with same content
+                name_taken = True
+            if name_taken:
                 # Filename conflict with different content
                 suffix = generate_timestamp_suffix()
                 new_name = f"{filepath.stem}_{suffix}{filepath.suffix}"
+                with claim_lock:
+                    # Same-named files can conflict within the same second
+                    n = 1
+                    while new_name in claimed_names or (dest_folder / new_name).exists():
+                        new_name = f"{filepath.stem}_{suffix}_{n}{filepath.suffix}"
+                        n += 1
+                    claimed_names.add(new_name)
                 dest_path = dest_folder / new_name
                 msg = f"Filename conflict for '{filepath.name}'. Copying as '{new_name}'."
                 if logger: logger.info(msg)
             msg = f"Copying '{filepath.name}' to '{dest_path.name}'..."
             if logger: logger.info(msg)
-            shutil.copy2(filepath, dest_path)
+            fast_copy(filepath, dest_path)
             # Extract media metadata - SKIPPED for now to focus on file management
-            # extracted_metadata_json = get_media_metadata(filepath, media_type, logger)
-            # metadata_extracted = False
-            # try:
-            #     meta_obj = json.loads(extracted_metadata_json)
-            #     if meta_obj:
-            #         metadata_extracted = True
-            # except Exception:
-            #     metadata_extracted = False
-            perceptual_hash = _get_perceptual_hash(filepath, media_type, logger)
+            # extracted_metadata_json, metadata_extracted = extract_media_metadata(filepath, media_type, logger)
+            perceptual_hash = _get_perceptual_hash(filepath, media_type, logger, check_header=False)
             metadata = {
                 'file_hash': file_hash,
                 'current_filename': dest_path.name,
                 'current_path': _to_relative_path(dest_path, memory_path),
-                'size': filepath.stat().st_size,
+                'size': st.st_size,
                 'media_type': media_type,
                 'date_added': datetime.now().isoformat(),
                 'extracted_metadata': None,  # Skip metadata for now
@@ -154,34 +229,80 @@ def _scan_and_process_folder(
             }
             return metadata
 
+        def process_file(filepath, st):
+            if stop_event.is_set():
+                return None
+            media_type = get_media_type(filepath)
+
+            # Validate file integrity before processing
+            if not is_valid_media_file(filepath):
+                msg = f"Skipping '{filepath.name}': Invalid or corrupted file (failed header check)."
+                if logger: logger.info(msg)
+                return None
+            
+            file_hash = _cached_file_hash(db, filepath, st, hashed)
+            digest = bytes.fromhex(file_hash) # Half the size of the hex string in claimed_hashes
+            with claim_lock:
+                duplicate = digest in claimed_hashes
+                claimed_hashes.add(digest)
+            if duplicate or db.has_hash(file_hash):
+                msg = f"Skipping '{filepath.name}': Duplicate file (hash: {file_hash})."
+                if logger: logger.info(msg)
+                return None
+            try:
+                return copy_file(filepath, st, media_type, file_hash)
+            except Exception:
+                # Nothing was copied, so another file with this content may still be
+                with claim_lock:
+                    claimed_hashes.discard(digest)
+                raise
+
+        pending = []
+        def flush_pending():
+            nonlocal new_files_processed
+            _flush_cached_hashes(db, hashed)
+            if not pending:
+                return
+            added = db.add_file_metadata_many(pending)
+            new_files_processed += added
+            if logger:
+                logger.info(f"Added {added} files to database.")
+                if added < len(pending):
+                    logger.info(f"Skipped {len(pending) - added} files already in database (should not happen if hash check passed).")
+            pending.clear()
+
         def signal_handler(sig, frame):
             print("\nInterrupt received, finishing current file and exiting safely...")
             stop_event.set()
 
+        out = BatchedOutput()
         old_handler = signal.signal(signal.SIGINT, signal_handler)
         try:
             with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-                futures = [executor.submit(process_file, f) for f in files_to_process]
-                for idx, future in enumerate(concurrent.futures.as_completed(futures), 1):
-                    if stop_event.is_set():
-                        break
+                completed = _iter_completed(
+                    executor, process_file, walk(), threads * FILES_QUEUED_PER_THREAD, stop_event
+                )
+                for _, future in completed:
                     try:
                         metadata = future.result()
                         processed_files += 1
-                        print(f"Processed {processed_files}/{total_files} files...", end='\r', flush=True)
+                        out.progress(f"Processed {processed_files} files...")
                         if metadata:
-                            if db.add_file_metadata(metadata):
-                                if logger: logger.info(f"Added '{metadata['current_filename']}' to database.")
-                                new_files_processed += 1
-                                managed_hashes.add(metadata['file_hash'])
-                            else:
-                                if logger: logger.info(f"Failed to add '{metadata['current_filename']}' to database (should not happen if hash check passed).")
+                            pending.append(metadata)
+                        if len(pending) >= INSERT_BATCH_SIZE or len(hashed) >= INSERT_BATCH_SIZE:
+                            flush_pending()
                     except Exception as e:
                         if logger: logger.error(f"Exception during file processing: {e}")
         finally:
+            # Files are already copied, record them even when interrupted
+            flush_pending()
+            out.flush()
             signal.signal(signal.SIGINT, old_handler)
+        if not stop_event.is_set():
+            # Only media files were walked; hashes scan cached for other files stay
+            db.prune_hash_cache(str(source_folder), seen_paths, recursive=recursive, name_filter=get_media_type_by_name)
 
-        print(' ' * 60, end='\r')  # Clear the progress line
+        out.clear_progress()
         if new_files_processed == 0:
             print("No new media files found.")
             if logger: logger.info("No new media files found.")
@@ -192,22 +313,29 @@ def _scan_and_process_folder(
     except Exception as e:
         print(f"An error occurred during scan and process: {e}")
         if logger: logger.error(f"An error occurred during scan and process: {e}")
-    finally:
-        db.close()
 
-def _get_perceptual_hash(filepath: Path, media_type: str, logger=None) -> str | None:
+def _get_perceptual_hash(filepath: Path, media_type: str, logger=None, check_header: bool = True) -> str | None:
     try:
         if media_type == 'photo':
             with Image.open(filepath) as img:
+                # JPEGs can be decoded at 1/2 to 1/8 scale straight from the DCT
+                # data; pHash only needs 32x32 grayscale, so don't decode full size
+                img.draft('L', PHASH_DRAFT_SIZE)
                 return str(imagehash.phash(img))
         elif media_type == 'video':
+            # A 16 byte header read rules out broken or mislabelled files
+            # before OpenCV probes the container and sets up a decoder. Import
+            # has already checked it, so it passes check_header=False.
+            if check_header and not is_valid_media_file(filepath):
+                return None
             import os
             import sys
             # Redirect stderr to suppress FFmpeg messages
             with open(os.devnull, 'w') as devnull:
                 old_stderr = sys.stderr
-                sys.stderr = devnull
+                cap = None
                 try:
+                    sys.stderr = devnull
                     cap = cv2.VideoCapture(str(filepath))
                     frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
                     if frame_count == 0:
@@ -215,10 +343,15 @@ def _get_perceptual_hash(filepath: Path, media_type: str, logger=None) -> str |
                     cap.set(cv2.CAP_PROP_POS_FRAMES, frame_count // 2)
                     ret, frame = cap.read()
                     if ret:
-                        img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                        # pHash only looks at luminance, so go straight to a single
+                        # grayscale plane instead of a full RGB copy of the frame
+                        img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
                         return str(imagehash.phash(img))
                 finally:
+                    # Restored before devnull is closed, even if VideoCapture raised
                     sys.stderr = old_stderr
+                    if cap is not None:
+                        cap.release()
     except Exception as e:
         if logger:
             logger.warning(f"Could not compute perceptual hash for {filepath}: {e}")
@@ -266,8 +399,7 @@ def upload_dry_run():
         print(f"Error: Memory not initialized in '{home_folder}'. Run 'memory init' first.")
         return
 
-    db = MemoryDB(db_path)
-    db.connect()
+    db = get_db(db_path)
     try:
         unuploaded_files = db.get_unuploaded_files()
         if not unuploaded_files:
@@ -281,11 +413,30 @@ def upload_dry_run():
         print(f"Total: {len(unuploaded_files)} files would be uploaded.")
     except Exception as e:
         print(f"An error occurred during dry run: {e}")
-    finally:
-        db.close()
 
-def upload_to_cloud(cloud_target: str):
-    """Uploads new files to the specified cloud storage."""
+def _upload_file(file_path: Path, file_meta: Dict[str, Any], cloud_target: str, stop_event) -> bool:
+    """
+    Uploads a single file to the cloud target. Runs on an upload worker thread.
+    Returns False if the upload was skipped because of an interrupt.
+    """
+    if stop_event.is_set():
+        return False
+    # --- THIS IS WHERE ACTUAL CLOUD UPLOAD LOGIC WOULD GO ---
+    # For bootstrap, we'll simulate it.
+    # In a real scenario, you'd use libraries like boto3 for S3,
+    # google-cloud-storage for GCloud, azure-storage-blob for Azure.
+    # Simulate upload success with a delay to mimic network operation
+    import time
+    time.sleep(0.5) # Simulate network latency
+    # --------------------------------------------------------
+    return True
+
+def upload_to_cloud(cloud_target: str, threads: int = 8):
+    """
+    Uploads new files to the specified cloud storage.
+    Uploads are network bound, so several run concurrently on a thread pool;
+    the database is only updated from this thread as uploads complete.
+    """
     home_folder = _get_home_folder_path()
     memory_path = _get_memory_path()
     db_path = _get_db_path()
@@ -301,52 +452,60 @@ def upload_to_cloud(cloud_target: str):
     import threading
     stop_event = threading.Event()
     def signal_handler(sig, frame):
-        print("\nInterrupt received, finishing current file and exiting safely...")
+        print("\nInterrupt received, finishing in-flight uploads and exiting safely...")
         stop_event.set()
     old_handler = signal.signal(signal.SIGINT, signal_handler)
 
-    db = MemoryDB(db_path)
-    db.connect()
+    db = get_db(db_path)
+    out = BatchedOutput()
+    # Hashes of files uploaded but not yet marked in the database; written
+    # in batches, and in the finally block so an interrupted run keeps them
+    uploaded = []
     try:
         unuploaded_files = db.get_unuploaded_files(cloud_target)
         if not unuploaded_files:
             print(f"No new files to upload to {cloud_target.upper()}.")
             return
 
-        print(f"\n--- Uploading {len(unuploaded_files)} files to {cloud_target.upper()} ---")
-        for i, file_meta in enumerate(unuploaded_files):
-            if stop_event.is_set():
-                break
-            file_path = _from_relative_path(file_meta['current_path'], memory_path)
-            if not file_path.exists():
-                print(f"Warning: File '{file_meta['current_filename']}' not found at '{file_path}'. Skipping.")
-                continue
-
-            print(f"  [{i+1}/{len(unuploaded_files)}] Uploading '{file_meta['current_filename']}'...")
-            
-            # --- THIS IS WHERE ACTUAL CLOUD UPLOAD LOGIC WOULD GO ---
-            # For bootstrap, we'll simulate it.
-            # In a real scenario, you'd use libraries like boto3 for S3,
-            # google-cloud-storage for GCloud, azure-storage-blob for Azure.
-            try:
-                # Simulate upload success with a delay to mimic network operation
-                import time
-                time.sleep(0.5) # Simulate network latency
-                print(f"    (Simulated upload successful for {file_meta['current_filename']})")
-                db.mark_uploaded(file_meta['file_hash'], cloud_target)
-                db.conn.commit()  # Commit after each file
-            except Exception as e:
-                print(f"    Error uploading '{file_meta['current_filename']}': {e}")
-                # Potentially log this and continue or retry
-            # --------------------------------------------------------
-
+        total = len(unuploaded_files)
+        print(f"\n--- Uploading {total} files to {cloud_target.upper()} (threads={threads}) ---")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            def uploadable():
+                for file_meta in unuploaded_files:
+                    file_path = _from_relative_path(file_meta['current_path'], memory_path)
+                    if not file_path.exists():
+                        out.write(f"Warning: File '{file_meta['current_filename']}' not found at '{file_path}'. Skipping.")
+                        continue
+                    yield file_path, file_meta, cloud_target, stop_event
+
+            # Only a couple of uploads per thread are queued at any time, the
+            # next one is submitted as each completes
+            completed = _iter_completed(
+                executor, _upload_file, uploadable(), threads * UPLOADS_QUEUED_PER_THREAD, stop_event
+            )
+            for i, ((_, file_meta, _, _), future) in enumerate(completed, 1):
+                try:
+                    if future.result():
+                        out.write(f"  [{i}/{total}] (Simulated upload successful for {file_meta['current_filename']})")
+                        uploaded.append(file_meta['file_hash'])
+                        if len(uploaded) >= INSERT_BATCH_SIZE:
+                            db.mark_uploaded_many(uploaded, cloud_target)
+                            uploaded.clear()
+                except Exception as e:
+                    out.write(f"    Error uploading '{file_meta['current_filename']}': {e}")
+                    # Potentially log this and continue or retry
+
+        out.flush()
         print(f"Upload to {cloud_target.upper()} complete.")
 
     except Exception as e:
+        out.flush()
         print(f"An error occurred during upload: {e}")
     finally:
+        if uploaded:
+            db.mark_uploaded_many(uploaded, cloud_target)
+        out.flush()
         signal.signal(signal.SIGINT, old_handler)
-        db.close()
 
 def delete_memory():
     """
@@ -359,25 +518,28 @@ def delete_memory():
         return
     # Delete all files tracked in the database
     try:
-        db = MemoryDB(db_path)
-        db.connect()
-        cursor = db.conn.cursor()
-        cursor.execute("SELECT current_path FROM files")
-        files = cursor.fetchall()
-        for row in files:
-            file_path = _from_relative_path(row[0], memory_path)
-            try:
-                if file_path.exists():
-                    file_path.unlink()
-                    print(f"Deleted file: {file_path}")
-                else:
-                    print(f"File not found (already deleted?): {file_path}")
-            except Exception as e:
-                print(f"Error deleting file {file_path}: {e}")
-        db.close()
+        db = get_db(db_path)
+        out = BatchedOutput()
+        # The rows aren't deleted one by one, the database goes away with the
+        # folder below. Paths are streamed from the cursor rather than fetched
+        # into one list first.
+        try:
+            for (current_path,) in db.conn.execute("SELECT current_path FROM files"):
+                file_path = _from_relative_path(current_path, memory_path)
+                # Just unlink, a missing file shows up as FileNotFoundError
+                try:
+                    os.unlink(file_path)
+                    out.write(f"Deleted file: {file_path}")
+                except FileNotFoundError:
+                    out.write(f"File not found (already deleted?): {file_path}")
+                except Exception as e:
+                    out.write(f"Error deleting file {file_path}: {e}")
+        finally:
+            out.flush()
     except Exception as e:
         print(f"Error deleting files from database: {e}")
     # Now remove the .memory folder
+    close_db(db_path)
     try:
         import shutil
         shutil.rmtree(memory_path)
@@ -398,31 +560,27 @@ def print_stats(no_metadata=False):
         print(f"Error: Memory not initialized in '{home_folder}'. Run 'memory init' first.")
         return
 
-    db = MemoryDB(db_path)
-    db.connect()
+    db = get_db(db_path)
     try:
         cursor = db.conn.cursor()
         
+        # All totals come from a single pass over the table
+        query = """
+            SELECT COUNT(*),
+                   COALESCE(SUM(size), 0),
+                   COALESCE(SUM(metadata_extracted = 1), 0),
+                   COALESCE(SUM(uploaded_s3 = 1 OR uploaded_gcloud = 1 OR uploaded_azure = 1), 0)
+            FROM files
+        """
         if no_metadata:
             # Show stats only for files without metadata extracted
-            cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files WHERE metadata_extracted = 0")
-            total_files, total_size = cursor.fetchone()
-            
-            cursor.execute("SELECT COUNT(*) FROM files WHERE metadata_extracted = 0 AND (uploaded_s3 = 1 OR uploaded_gcloud = 1 OR uploaded_azure = 1)")
-            uploaded_count = cursor.fetchone()[0]
-            
+            query += " WHERE metadata_extracted = 0"
+        cursor.execute(query)
+        total_files, total_size, metadata_extracted_count, uploaded_count = cursor.fetchone()
+
+        if no_metadata:
             print("\n--- Memory Stats (Files WITHOUT Metadata) ---")
         else:
-            # Show stats for all files
-            cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files")
-            total_files, total_size = cursor.fetchone()
-
-            cursor.execute("SELECT COUNT(*) FROM files WHERE metadata_extracted = 1")
-            metadata_extracted_count = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(*) FROM files WHERE uploaded_s3 = 1 OR uploaded_gcloud = 1 OR uploaded_azure = 1")
-            uploaded_count = cursor.fetchone()[0]
-            
             print("\n--- Memory Stats ---")
 
         not_uploaded_count = total_files - uploaded_count
@@ -442,23 +600,15 @@ def print_stats(no_metadata=False):
             print(f"Files uploaded: {uploaded_count} ({uploaded_count/total_files*100:.1f}%)")
             print(f"Files not uploaded: {not_uploaded_count} ({not_uploaded_count/total_files*100:.1f}%)")
 
-            # Per-format stats
+            # Per-format stats, aggregated by SQLite from the (ext, size) index
+            format_query = "SELECT ext, COUNT(*), SUM(size) FROM files"
             if no_metadata:
-                cursor.execute("SELECT current_filename, size FROM files WHERE metadata_extracted = 0")
-            else:
-                cursor.execute("SELECT current_filename, size FROM files")
-            from collections import defaultdict
-            format_counts = defaultdict(int)
-            format_sizes = defaultdict(int)
-            for filename, size in cursor.fetchall():
-                ext = filename.lower().rsplit('.', 1)[-1] if '.' in filename else ''
-                format_counts[ext] += 1
-                format_sizes[ext] += size
+                format_query += " WHERE metadata_extracted = 0"
+            format_query += " GROUP BY ext ORDER BY COUNT(*) DESC, ext"
+            cursor.execute(format_query)
             print("\nPer-format statistics:")
             print(f"{'Format':<8} {'Count':>8} {'%Files':>8} {'Size':>14} {'%Size':>8}")
-            for ext in sorted(format_counts, key=lambda x: (-format_counts[x], x)):
-                count = format_counts[ext]
-                size = format_sizes[ext]
+            for ext, count, size in cursor.fetchall():
                 pct_files = count / total_files * 100
                 pct_size = size / total_size * 100 if total_size > 0 else 0
                 print(f"{ext or '(none)':<8} {count:8d} {pct_files:8.1f} {human_readable_size(size):>14} {pct_size:8.1f}")
@@ -470,8 +620,6 @@ def print_stats(no_metadata=False):
         print("-------------------\n")
     except Exception as e:
         print(f"Error gathering stats: {e}")
-    finally:
-        db.close()
 
 def delete_file_by_id(record_id):
     """
@@ -485,8 +633,7 @@ def delete_file_by_id(record_id):
         print(f"Error: Memory not initialized in '{home_folder}'. Run 'memory init' first.")
         return
 
-    db = MemoryDB(db_path)
-    db.connect()
+    db = get_db(db_path)
     try:
         cursor = db.conn.cursor()
         cursor.execute("SELECT current_path FROM files WHERE file_hash = ?", (record_id,))
@@ -496,11 +643,10 @@ def delete_file_by_id(record_id):
             return
         file_path = _from_relative_path(row[0], memory_path)
         try:
-            if file_path.exists():
-                file_path.unlink()
-                print(f"Deleted file: {file_path}")
-            else:
-                print(f"File not found on disk (already deleted?): {file_path}")
+            os.unlink(file_path)
+            print(f"Deleted file: {file_path}")
+        except FileNotFoundError:
+            print(f"File not found on disk (already deleted?): {file_path}")
         except Exception as e:
             print(f"Error deleting file {file_path}: {e}")
         cursor.execute("DELETE FROM files WHERE file_hash = ?", (record_id,))
@@ -508,8 +654,6 @@ def delete_file_by_id(record_id):
         print(f"Deleted database record for file_hash: {record_id}")
     except Exception as e:
         print(f"Error deleting file by id: {e}")
-    finally:
-        db.close()
 
 def detect_samesize(videos=False, photos=False):
     """
@@ -524,35 +668,38 @@ def detect_samesize(videos=False, photos=False):
         print(f"Error: Memory not initialized in '{home_folder}'. Run 'memory init' first.")
         return
 
-    db = MemoryDB(db_path)
-    db.connect()
+    db = get_db(db_path)
     try:
         cursor = db.conn.cursor()
-        query = "SELECT size, current_filename, current_path, media_type FROM files"
-        cursor.execute(query)
-        from collections import defaultdict
-        size_groups = defaultdict(list)
-        for size, filename, path, media_type in cursor.fetchall():
-            if videos and media_type != 'video':
-                continue
-            if photos and media_type != 'photo':
-                continue
-            size_groups[size].append((filename, path))
+        conditions, params = [], []
+        if videos:
+            conditions.append("media_type = ?")
+            params.append('video')
+        if photos:
+            conditions.append("media_type = ?")
+            params.append('photo')
+        where = " AND ".join(conditions) or "1"
+        # Sizes that occur more than once come straight off idx_files_size;
+        # only the rows in those groups are read and sent to Python
+        query = (
+            "SELECT size, current_filename, current_path FROM files "
+            f"WHERE {where} AND size IN (SELECT size FROM files WHERE {where} GROUP BY size HAVING COUNT(*) > 1) "
+            "ORDER BY size"
+        )
+        cursor.execute(query, params + params)
+        memory_abs = memory_path.resolve() # Once, instead of a realpath per file
         found = False
-        for size, files in size_groups.items():
-            if len(files) > 1:
-                found = True
-                print(f"\nSize: {size} bytes - {len(files)} files:")
-                for filename, path in files:
-                    abs_path = str(_from_relative_path(path, memory_path).resolve())
-                    file_url = 'file://' + urllib.parse.quote(abs_path)
-                    print(f"  {filename}  ({file_url})")
+        for size, rows in itertools.groupby(cursor, key=lambda row: row[0]):
+            files = [(filename, path) for _, filename, path in rows]
+            found = True
+            print(f"\nSize: {size} bytes - {len(files)} files:")
+            for filename, path in files:
+                file_url = _from_relative_path(path, memory_abs).as_uri()
+                print(f"  {filename}  ({file_url})")
         if not found:
             print("No groups of files with the same size found.")
     except Exception as e:
         print(f"Error during same-size detection: {e}")
-    finally:
-        db.close()
 
 def detect_visual(videos=False, photos=False, threshold=5):
     """
@@ -566,11 +713,10 @@ def detect_visual(videos=False, photos=False, threshold=5):
         print(f"Error: Memory not initialized in '{home_folder}'. Run 'memory init' first.")
         return
 
-    db = MemoryDB(db_path)
-    db.connect()
+    db = get_db(db_path)
     try:
         cursor = db.conn.cursor()
-        query = "SELECT file_hash, current_filename, current_path, media_type, perceptual_hash FROM files WHERE perceptual_hash IS NOT NULL"
+        query = "SELECT file_hash, current_filename, current_path, media_type, perceptual_hash_int FROM files WHERE perceptual_hash_int IS NOT NULL"
         cursor.execute(query)
         files = []
         for file_hash, filename, path, media_type, phash in cursor.fetchall():
@@ -579,38 +725,31 @@ def detect_visual(videos=False, photos=False, threshold=5):
             if photos and media_type != 'photo':
                 continue
             files.append((file_hash, filename, path, media_type, phash))
-        # Group by similarity
-        from collections import defaultdict
-        visited = set()
-        groups = []
-        for i, (fh1, fn1, p1, mt1, ph1) in enumerate(files):
-            if fh1 in visited:
-                continue
-            group = [(fn1, p1)]
-            visited.add(fh1)
-            hash1 = imagehash.hex_to_hash(ph1)
-            for j, (fh2, fn2, p2, mt2, ph2) in enumerate(files):
-                if i == j or fh2 in visited:
-                    continue
-                hash2 = imagehash.hex_to_hash(ph2)
-                if hash1 - hash2 <= threshold:
-                    group.append((fn2, p2))
-                    visited.add(fh2)
-            if len(group) > 1:
-                groups.append(group)
+        # Group by similarity. Hashes go into a BK-tree so each file only gets
+        # compared against the part of the collection that can be within threshold,
+        # and similar pairs are merged with union-find, so a file close to two
+        # others ends up in one group with both of them.
+        tree = BKTree()
+        hashes = [ph & 0xFFFFFFFFFFFFFFFF for _, _, _, _, ph in files] # Back to unsigned
+        for i, h in enumerate(hashes):
+            tree.insert(h, i)
+        links = DisjointSet(len(files))
+        for i, h in enumerate(hashes):
+            for _, j in tree.find(h, threshold):
+                if j > i:
+                    links.union(i, j)
+        groups = [[(files[i][1], files[i][2]) for i in members] for members in links.groups()]
         if not groups:
             print("No visually similar files found.")
         else:
+            memory_abs = memory_path.resolve() # Once, instead of a realpath per file
             for group in groups:
                 print(f"\nVisually similar files:")
                 for filename, path in group:
-                    abs_path = str(_from_relative_path(path, memory_path).resolve())
-                    file_url = 'file://' + urllib.parse.quote(abs_path)
+                    file_url = _from_relative_path(path, memory_abs).as_uri()
                     print(f"  {filename}  ({file_url})")
     except Exception as e:
         print(f"Error during visual similarity detection: {e}")
-    finally:
-        db.close()
 
 def populate_perceptual_hashes():
     """
@@ -629,8 +768,7 @@ def populate_perceptual_hashes():
     logging.basicConfig(filename=log_file, filemode='w', level=logging.INFO, format='%(asctime)s %(message)s')
     logger = logging.getLogger('memory_populate_hash')
 
-    db = MemoryDB(db_path)
-    db.connect()
+    db = get_db(db_path)
     try:
         cursor = db.conn.cursor()
         cursor.execute("SELECT file_hash, current_path, media_type FROM files WHERE perceptual_hash IS NULL OR perceptual_hash = ''")
@@ -640,29 +778,41 @@ def populate_perceptual_hashes():
             print("All files already have perceptual hashes.")
             logger.info("All files already have perceptual hashes.")
             return
-        updated = 0
-        for idx, (file_hash, path, media_type) in enumerate(rows, 1):
-            print(f"Processing file {idx} of {total} ...", end='\r', flush=True)
+        jobs = []
+        for file_hash, path, media_type in rows:
             file_path = _from_relative_path(path, memory_path)
             if not file_path.exists():
                 logger.warning(f"File not found: {file_path}, skipping.")
                 continue
-            phash = _get_perceptual_hash(file_path, media_type, logger)
-            if phash:
-                cursor.execute("UPDATE files SET perceptual_hash = ? WHERE file_hash = ?", (phash, file_hash))
-                updated += 1
-                logger.info(f"Populated perceptual hash for: {file_path}")
-            else:
-                logger.warning(f"Could not compute perceptual hash for: {file_path}")
-        db.conn.commit()
-        print(' ' * 60, end='\r')  # Clear the progress line
+            jobs.append((file_hash, file_path, media_type))
+        # Decoding and hashing images is CPU bound, so it's spread over a
+        # process pool; results are written back in a single transaction
+        updates = []
+        out = BatchedOutput()
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            phashes = executor.map(
+                _get_perceptual_hash,
+                [file_path for _, file_path, _ in jobs],
+                [media_type for _, _, media_type in jobs],
+                itertools.repeat(logger),
+                chunksize=PHASH_CHUNK_SIZE
+            )
+            for idx, ((file_hash, file_path, _), phash) in enumerate(zip(jobs, phashes), 1):
+                out.progress(f"Processing file {idx} of {total} ...", final=idx == len(jobs))
+                if phash:
+                    updates.append((phash, phash_to_int(phash), file_hash))
+                    logger.info(f"Populated perceptual hash for: {file_path}")
+                else:
+                    logger.warning(f"Could not compute perceptual hash for: {file_path}")
+        updated = len(updates)
+        with db.conn:
+            db.conn.executemany("UPDATE files SET perceptual_hash = ?, perceptual_hash_int = ? WHERE file_hash = ?", updates)
+        out.clear_progress()
         print(f"Populated perceptual hashes for {updated} files.")
         logger.info(f"Populated perceptual hashes for {updated} files.")
     except Exception as e:
         print(f"Error during perceptual hash population: {e}")
         logger.error(f"Error during perceptual hash population: {e}")
-    finally:
-        db.close()
 
 def migrate_files_to_memory():
     """
@@ -685,8 +835,7 @@ def migrate_files_to_memory():
         print(f"Error: Memory not initialized in '{home_folder}'. Run 'memory init' first.")
         return
 
-    db = MemoryDB(db_path)
-    db.connect()
+    db = get_db(db_path)
     try:
         cursor = db.conn.cursor()
         cursor.execute("SELECT file_hash, current_path FROM files")
@@ -704,8 +853,14 @@ def migrate_files_to_memory():
             dest_path = memory_path / abs_path.name
             # Handle name conflicts
             if dest_path.exists():
-                # If same file, skip; else, add suffix
-                if calculate_file_hash(dest_path) == calculate_file_hash(abs_path):
+                # If same file, skip; else, add suffix. A destination that is
+                # itself managed has its hash on record, so nothing is read.
+                dest_hash = db.get_hash_by_current_path(_to_relative_path(dest_path, memory_path))
+                if dest_hash is not None:
+                    same_content = dest_hash == file_hash
+                else:
+                    same_content = files_have_same_content(dest_path, abs_path)
+                if same_content:
                     print(f"File already exists in .memory: {dest_path}, skipping.")
                     continue
                 else:
@@ -714,7 +869,13 @@ def migrate_files_to_memory():
                     print(f"Filename conflict, moving as: {dest_path}")
             shutil.move(str(abs_path), str(dest_path))
             rel_path = _to_relative_path(dest_path, memory_path)
-            cursor.execute("UPDATE files SET current_path = ? WHERE file_hash = ?", (rel_path, file_hash))
+            # Record where the file was before the move, unless an original
+            # location is already stored
+            cursor.execute(
+                "UPDATE files SET original_path = COALESCE(original_path, current_path), "
+                "original_filename = COALESCE(original_filename, current_filename), "
+                "current_path = ?, current_filename = ?, ext = ? WHERE file_hash = ?",
+                (rel_path, dest_path.name, file_ext(dest_path.name), file_hash))
             db.conn.commit()  # Commit after each file
             moved += 1
         print(f"Moved {moved} files into .memory folder.")
@@ -722,7 +883,6 @@ def migrate_files_to_memory():
         print(f"Error during file migration: {e}")
     finally:
         signal.signal(signal.SIGINT, old_handler)
-        db.close()
 
 def migrate_files_table():
     """
@@ -745,12 +905,14 @@ def migrate_files_table():
         'size': 'INTEGER',
         'media_type': 'TEXT',
         'date_added': 'TEXT',
-        'extracted_metadata': 'TEXT',
+        'extracted_metadata': 'BLOB',
         'uploaded_s3': 'BOOLEAN DEFAULT FALSE',
         'uploaded_gcloud': 'BOOLEAN DEFAULT FALSE',
         'uploaded_azure': 'BOOLEAN DEFAULT FALSE',
         'metadata_extracted': 'BOOLEAN DEFAULT FALSE',
-        'perceptual_hash': 'TEXT'
+        'perceptual_hash': 'TEXT',
+        'meta_len': 'INTEGER',
+        'perceptual_hash_int': 'INTEGER'
     }
     import sqlite3
     conn = sqlite3.connect(db_path)
@@ -764,11 +926,39 @@ def migrate_files_table():
             cursor.execute(f"ALTER TABLE files ADD COLUMN {col} {coltype};")
             added += 1
     conn.commit()
-    conn.close()
     if added == 0:
         print("No columns needed to be added. Schema is up to date.")
     else:
         print(f"Migration complete. {added} columns added.")
+    # Recompress metadata written by older versions (plain JSON text or gzip) with zstd
+    cursor.execute(
+        "SELECT file_hash, extracted_metadata FROM files "
+        "WHERE typeof(extracted_metadata) = 'text' OR substr(extracted_metadata, 1, 2) = x'1f8b'"
+    )
+    recompressed = [(compress_metadata(decompress_metadata(blob)), file_hash) for file_hash, blob in cursor.fetchall()]
+    if recompressed:
+        cursor.executemany("UPDATE files SET extracted_metadata = ? WHERE file_hash = ?", recompressed)
+        conn.commit()
+        print(f"Recompressed metadata for {len(recompressed)} files.")
+    if backfill_meta_len(conn):
+        conn.commit()
+    filled = backfill_perceptual_hash_int(conn)
+    if filled:
+        conn.commit()
+        print(f"Converted perceptual hashes to integers for {filled} files.")
+    # original_* are only kept when they differ from current_*; a copy of the
+    # current value tells readers nothing. Shrinks every row that was never
+    # renamed or moved.
+    cursor.execute("UPDATE files SET original_path = NULL WHERE original_path = current_path")
+    cleared = cursor.rowcount
+    cursor.execute("UPDATE files SET original_filename = NULL WHERE original_filename = current_filename")
+    cleared += cursor.rowcount
+    conn.commit()
+    if cleared:
+        print(f"Cleared {cleared} redundant original_path/original_filename values.")
+        # Give the freed space back and repack the rows into fewer pages
+        conn.execute("VACUUM")
+    conn.close()
     # After column migration, migrate paths to relative
     migrate_paths_to_relative()
     migrate_files_to_memory()
@@ -793,30 +983,48 @@ def migrate_paths_to_relative():
         print(f"Error: Memory not initialized in '{home_folder}'. Run 'memory init' first.")
         return
 
-    db = MemoryDB(db_path)
-    db.connect()
+    db = get_db(db_path)
     try:
         cursor = db.conn.cursor()
-        cursor.execute("SELECT file_hash, current_path, original_path FROM files")
+        # Relative paths come back unchanged, so only rows holding an absolute
+        # path (POSIX, or a Windows drive/UNC path) need converting
+        is_absolute = "(substr({0}, 1, 1) IN ('/', '\\') OR substr({0}, 2, 1) = ':')"
+        cursor.execute(
+            "SELECT file_hash, current_path, original_path FROM files "
+            f"WHERE {is_absolute.format('current_path')} OR {is_absolute.format('original_path')}"
+        )
         rows = cursor.fetchall()
         updated = 0
+        pending = []
+        def flush_pending():
+            # One transaction per batch; only database rows change here, so an
+            # interrupt just stops before the next batch
+            with db.conn:
+                db.conn.executemany("UPDATE files SET current_path = ?, original_path = ? WHERE file_hash = ?", pending)
+            pending.clear()
         for file_hash, current_path, original_path in rows:
             if stop_event.is_set():
                 break
             rel_current = _to_relative_path(_from_relative_path(current_path, memory_path), memory_path)
-            rel_original = _to_relative_path(_from_relative_path(original_path, memory_path), memory_path)
+            rel_original = None
+            if original_path is not None:
+                rel_original = _to_relative_path(_from_relative_path(original_path, memory_path), memory_path)
+                if rel_original == rel_current:
+                    rel_original = None # Same as current_path, not worth storing
             if rel_current != current_path or rel_original != original_path:
-                cursor.execute("UPDATE files SET current_path = ?, original_path = ? WHERE file_hash = ?", (rel_current, rel_original, file_hash))
-                db.conn.commit()  # Commit after each file
+                pending.append((rel_current, rel_original, file_hash))
                 updated += 1
+                if len(pending) >= INSERT_BATCH_SIZE:
+                    flush_pending()
+        if pending:
+            flush_pending()
         print(f"Migrated {updated} records to relative paths.")
     except Exception as e:
         print(f"Error during path migration: {e}")
     finally:
         signal.signal(signal.SIGINT, old_handler)
-        db.close()
 
-def scan_unmanaged_files(folder):
+def scan_unmanaged_files(folder, threads: int = 4):
     """
     Scan the specified folder for files not under management and print stats by total number, total size, and by extension (case-insensitive).
     """
@@ -829,50 +1037,67 @@ def scan_unmanaged_files(folder):
         print(f"Error: {folder} is not a directory.")
         return
 
-    managed_hashes = set()
+    # Managed files are recognised with indexed lookups as the scan goes,
+    # rather than loading every managed hash into memory first
+    db = None
     if memory_path.exists():
-        db = MemoryDB(db_path)
-        db.connect()
         try:
-            managed_hashes = set(db.get_all_file_hashes())
+            db = get_db(db_path)
         except Exception as e:
             print(f"Error reading managed hashes: {e}")
-        finally:
-            db.close()
 
     total_files = 0
     total_size = 0
-    from collections import defaultdict
-    ext_counts = defaultdict(int)
-    ext_sizes = defaultdict(int)
-
-    import hashlib
-    def get_sha256(path):
-        h = hashlib.sha256()
-        with open(path, 'rb') as f:
-            while True:
-                chunk = f.read(65536)
-                if not chunk:
-                    break
-                h.update(chunk)
-        return h.hexdigest()
-
-    for file_path in folder.rglob('*'):
-        if not file_path.is_file():
-            continue
-        try:
-            file_hash = get_sha256(file_path)
-        except Exception as e:
-            print(f"Error hashing {file_path}: {e}")
-            continue
-        if file_hash in managed_hashes:
-            continue
+    from collections import Counter
+    ext_counts = Counter()
+    ext_sizes = Counter()
+
+    def count_unmanaged(file_path, st):
+        nonlocal total_files, total_size
         total_files += 1
-        size = file_path.stat().st_size
-        total_size += size
-        ext = file_path.suffix.lower().lstrip('.')
+        total_size += st.st_size
+        ext = file_ext(file_path.name) # Same folding as the files table's ext column
         ext_counts[ext] += 1
-        ext_sizes[ext] += size
+        ext_sizes[ext] += st.st_size
+
+    seen_paths = set() # For pruning hash_cache once the walk completes
+    def needs_hash():
+        # Managed copies live in this home's .memory folder, which is pruned
+        # during the walk. Other .memory folders (another library's, say) are
+        # scanned like any other directory.
+        for file_path, st in iter_files(folder, skip_paths=frozenset({str(memory_path.resolve())})):
+            seen_paths.add(str(file_path))
+            # A file can only be managed if some managed file has its size,
+            # the content is only read to tell those apart
+            if db is not None and db.has_size(st.st_size):
+                yield file_path, st
+            else:
+                count_unmanaged(file_path, st)
+
+    # Hashing releases the GIL, so candidates are hashed on a thread pool
+    # while the walk goes on; lookups and counting stay on this thread.
+    # Hashes are cached by path, size, mtime and inode, so a rescan only stats files.
+    import threading
+    hashed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        completed = _iter_completed(
+            executor, lambda file_path, st: _cached_file_hash(db, file_path, st, hashed), needs_hash(),
+            threads * FILES_QUEUED_PER_THREAD, threading.Event()
+        )
+        for (file_path, st), future in completed:
+            if len(hashed) >= INSERT_BATCH_SIZE:
+                _flush_cached_hashes(db, hashed)
+            try:
+                if db.has_hash(future.result()):
+                    continue
+            except Exception as e:
+                print(f"Error hashing {file_path}: {e}")
+                continue
+            count_unmanaged(file_path, st)
+    if hashed:
+        _flush_cached_hashes(db, hashed)
+    if db is not None:
+        db.prune_hash_cache(str(folder), seen_paths)
 
     def human_readable_size(size_bytes):
         for unit in ['B','KB','MB','GB','TB','PB']:
@@ -885,8 +1110,9 @@ def scan_unmanaged_files(folder):
     print(f"Total files: {total_files}")
     print(f"Total size: {total_size} bytes ({human_readable_size(total_size)})")
     print(f"{'Extension':<10} {'Count':>8} {'%Files':>8} {'Size':>14} {'%Size':>8}")
-    for ext in sorted(ext_counts, key=lambda x: (-ext_counts[x], x)):
-        count = ext_counts[ext]
+    # Most files first, then by name; the sort compares plain tuples
+    for neg_count, ext in sorted((-count, ext) for ext, count in ext_counts.items()):
+        count = -neg_count
         size = ext_sizes[ext]
         pct_files = count / total_files * 100 if total_files > 0 else 0
         pct_size = size / total_size * 100 if total_size > 0 else 0
@@ -1,20 +1,231 @@
+import atexit
 import gzip
 import json
+import os
 import sqlite3
+import threading
 from pathlib import Path
 from typing import List, Dict, Any, Tuple
 
+import zstandard as zstd
+
+from memory.utils import file_ext
+
 DB_NAME = "metadata.db"
+UPLOAD_TARGETS = ('s3', 'gcloud', 'azure')
+
+# extracted_metadata blobs are told apart by their leading bytes: zstd frames
+# (current), gzip (older databases) or plain JSON (oldest databases, and
+# current ones for metadata too small to be worth compressing).
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAX_FRAME_HEADER = 18 # Longest possible zstd frame header, in bytes
+
+# Below this many bytes of JSON, zstd's frame overhead outweighs what it saves,
+# so the JSON is stored as is (a plain blob is read back as UTF-8 JSON)
+_MIN_COMPRESS_SIZE = 256
+
+# zstd contexts are reused rather than built per call, one set per thread
+# since a context must not be used by two threads at once
+_zstd_contexts = threading.local()
+
+def _zstd_compressor() -> zstd.ZstdCompressor:
+    cctx = getattr(_zstd_contexts, 'cctx', None)
+    if cctx is None:
+        cctx = _zstd_contexts.cctx = zstd.ZstdCompressor(level=3)
+    return cctx
+
+def _zstd_decompressor() -> zstd.ZstdDecompressor:
+    dctx = getattr(_zstd_contexts, 'dctx', None)
+    if dctx is None:
+        dctx = _zstd_contexts.dctx = zstd.ZstdDecompressor()
+    return dctx
+
+def compress_metadata(metadata_json: str) -> bytes:
+    """Compresses a metadata JSON string for storage in extracted_metadata."""
+    raw = metadata_json.encode('utf-8')
+    if len(raw) < _MIN_COMPRESS_SIZE:
+        return raw
+    return _zstd_compressor().compress(raw)
+
+def decompress_metadata(blob) -> str | None:
+    """Returns the JSON string stored in an extracted_metadata value, whatever codec it was written with."""
+    if blob is None:
+        return None
+    if isinstance(blob, str):
+        return blob
+    blob = bytes(blob)
+    if blob.startswith(_ZSTD_MAGIC):
+        return _zstd_decompressor().decompress(blob).decode('utf-8')
+    if blob.startswith(_GZIP_MAGIC):
+        return gzip.decompress(blob).decode('utf-8')
+    return blob.decode('utf-8')
+
+def metadata_length(conn: sqlite3.Connection, rowid: int) -> int | None:
+    """
+    Returns the uncompressed size in bytes of a row's extracted_metadata.
+    zstd frames record their content size in the frame header, so only the
+    first bytes of the blob are read, using incremental blob I/O where the
+    sqlite3 module has it (Python 3.11+). Other codecs are decompressed.
+    """
+    header = None
+    if hasattr(conn, 'blobopen'):
+        try:
+            with conn.blobopen('files', 'extracted_metadata', rowid, readonly=True) as blob:
+                header = blob.read(_ZSTD_MAX_FRAME_HEADER)
+        except sqlite3.OperationalError:
+            pass # NULL or TEXT values can't be opened as blobs
+    if header is not None and header.startswith(_ZSTD_MAGIC):
+        size = zstd.frame_content_size(header)
+        if size >= 0:
+            return size
+    value = conn.execute("SELECT extracted_metadata FROM files WHERE rowid = ?", (rowid,)).fetchone()[0]
+    metadata_json = decompress_metadata(value)
+    return None if metadata_json is None else len(metadata_json.encode('utf-8'))
+
+def backfill_meta_len(conn: sqlite3.Connection) -> int:
+    """Fills meta_len for rows written before the column existed. Returns the number of rows updated."""
+    cursor = conn.execute("SELECT rowid FROM files WHERE extracted_metadata IS NOT NULL AND meta_len IS NULL")
+    updates = [(metadata_length(conn, rowid), rowid) for (rowid,) in cursor.fetchall()]
+    if updates:
+        conn.executemany("UPDATE files SET meta_len = ? WHERE rowid = ?", updates)
+    return len(updates)
+
+_PHASH_MASK = (1 << 64) - 1
+
+def phash_to_int(phash: str | None) -> int | None:
+    """
+    Converts a 64-bit perceptual hash in hex to the value stored in
+    perceptual_hash_int. SQLite integers are signed, so the top bit becomes
+    the sign. Returns None for anything that isn't a 64-bit hash.
+    """
+    if not phash or len(phash) != 16:
+        return None
+    try:
+        value = int(phash, 16)
+    except ValueError:
+        return None
+    return value - (1 << 64) if value >> 63 else value
+
+def hamming_distance(a: int, b: int) -> int:
+    """Number of differing bits between two perceptual_hash_int values."""
+    return ((a ^ b) & _PHASH_MASK).bit_count()
+
+def backfill_perceptual_hash_int(conn: sqlite3.Connection) -> int:
+    """Fills perceptual_hash_int for rows hashed before the column existed. Returns the number of rows updated."""
+    cursor = conn.execute("SELECT rowid, perceptual_hash FROM files WHERE perceptual_hash IS NOT NULL AND perceptual_hash_int IS NULL")
+    updates = [(value, rowid) for rowid, phash in cursor.fetchall() if (value := phash_to_int(phash)) is not None]
+    if updates:
+        conn.executemany("UPDATE files SET perceptual_hash_int = ? WHERE rowid = ?", updates)
+    return len(updates)
+
+def _row_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    """
+    Converts a files row to a dict with extracted_metadata decompressed.
+    original_path/original_filename stay None when they aren't stored: import
+    never records them, and migrate clears them when they match current_*.
+    """
+    result = dict(row)
+    if result.get('extracted_metadata'):
+        try:
+            result['extracted_metadata'] = decompress_metadata(result['extracted_metadata'])
+        except Exception:
+            result['extracted_metadata'] = None
+    return result
+
+def backfill_ext(conn: sqlite3.Connection) -> int:
+    """Fills ext for rows written before the column existed. Returns the number of rows updated."""
+    cursor = conn.execute("SELECT rowid, current_filename FROM files WHERE ext IS NULL")
+    updates = [(file_ext(filename), rowid) for rowid, filename in cursor.fetchall()]
+    if updates:
+        conn.executemany("UPDATE files SET ext = ? WHERE rowid = ?", updates)
+    return len(updates)
+
+_ADDED_COLUMNS = {
+    # ext: file_ext(current_filename), written with the row. Lowercased in
+    # Python rather than by SQLite's lower(), which only folds ASCII.
+    'ext': "TEXT",
+    # meta_len: size in bytes of the uncompressed extracted_metadata JSON, so
+    # size statistics don't have to decompress every blob
+    'meta_len': "INTEGER",
+    # perceptual_hash_int: perceptual_hash as a (signed) 64-bit integer, so
+    # similarity checks XOR integers instead of parsing hex on every run
+    'perceptual_hash_int': "INTEGER",
+}
+
+_INSERT_FILE_SQL = '''
+    INSERT INTO files (file_hash, current_filename, current_path, size, media_type,
+                       date_added, extracted_metadata, meta_len, metadata_extracted, perceptual_hash,
+                       perceptual_hash_int, ext)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+_INSERT_FILE_OR_IGNORE_SQL = _INSERT_FILE_SQL.replace('INSERT INTO', 'INSERT OR IGNORE INTO', 1)
+_HAS_HASH_SQL = "SELECT 1 FROM files WHERE file_hash = ? LIMIT 1"
+_HAS_SIZE_SQL = "SELECT 1 FROM files WHERE size = ? LIMIT 1"
+_HASH_BY_CURRENT_PATH_SQL = "SELECT file_hash FROM files WHERE current_path = ? LIMIT 1"
+_CACHED_HASH_SQL = "SELECT file_hash FROM hash_cache WHERE path = ? AND mtime_ns = ? AND size = ? AND ino = ?"
+_CACHE_HASH_SQL = "INSERT OR REPLACE INTO hash_cache (path, mtime_ns, size, ino, file_hash) VALUES (?, ?, ?, ?, ?)"
+_MARK_UPLOADED_SQL = {
+    target: f"UPDATE files SET uploaded_{target} = TRUE WHERE file_hash = ?" for target in UPLOAD_TARGETS
+}
+
+# Statements compiled per connection and kept for reuse. The hot statements
+# above are fixed strings so every call hits this cache instead of re-preparing.
+_CACHED_STATEMENTS = 512
+
+# Stored in PRAGMA user_version once _create_tables has brought a database up
+# to date, so later connections skip it. Bump whenever _create_tables changes.
+SCHEMA_VERSION = 1
+
+def _file_metadata_params(metadata: Dict[str, Any]) -> Tuple:
+    """Builds the _INSERT_FILE_SQL parameters for a file metadata dict."""
+    # Compress metadata if present
+    meta_blob = meta_len = None
+    if metadata.get('extracted_metadata'):
+        meta_blob = compress_metadata(metadata['extracted_metadata'])
+        meta_len = len(metadata['extracted_metadata'].encode('utf-8'))
+    return (
+        metadata['file_hash'],
+        metadata['current_filename'],
+        metadata['current_path'],
+        metadata['size'],
+        metadata['media_type'],
+        metadata['date_added'],
+        meta_blob,
+        meta_len,
+        metadata.get('metadata_extracted', False),
+        metadata.get('perceptual_hash'),
+        phash_to_int(metadata.get('perceptual_hash')),
+        file_ext(metadata['current_filename'])
+    )
 
 class MemoryDB:
     def __init__(self, db_path: Path):
         self.db_path = db_path
         self.conn = None
+        # Serializes use of the connection by methods that may be called
+        # from worker threads (has_hash) against the main thread's writes
+        self._lock = threading.RLock()
 
     def connect(self):
-        self.conn = sqlite3.connect(self.db_path)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=_CACHED_STATEMENTS)
         self.conn.row_factory = sqlite3.Row # Allows accessing columns by name
-        self._create_tables()
+        # WAL + synchronous=NORMAL: commits no longer fsync the main database file
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute(f"PRAGMA mmap_size={1 << 30}")
+        # 64 MiB page cache (negative means KiB) instead of the default 2 MiB,
+        # the connection is shared for the whole process
+        self.conn.execute("PRAGMA cache_size=-65536")
+        # Lets SQL (e.g. analysis queries) look inside compressed metadata
+        self.conn.create_function('decompress_metadata', 1, decompress_metadata, deterministic=True)
+        # hamming(a, b) on perceptual_hash_int values, for similarity queries in SQL
+        self.conn.create_function('hamming', 2, hamming_distance, deterministic=True)
+        (user_version,) = self.conn.execute("PRAGMA user_version").fetchone()
+        if user_version < SCHEMA_VERSION:
+            self._create_tables()
 
     def close(self):
         if self.conn:
@@ -34,7 +245,7 @@ class MemoryDB:
                 size INTEGER NOT NULL,
                 media_type TEXT,
                 date_added TEXT NOT NULL,
-                extracted_metadata BLOB, -- Now compressed JSON
+                extracted_metadata BLOB, -- zstd compressed JSON
                 uploaded_s3 BOOLEAN DEFAULT FALSE,
                 uploaded_gcloud BOOLEAN DEFAULT FALSE,
                 uploaded_azure BOOLEAN DEFAULT FALSE,
@@ -42,92 +253,217 @@ class MemoryDB:
                 perceptual_hash TEXT
             )
         ''')
+        # Columns added after the table was first released, created in place
+        # so older databases get them too
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(files)")}
+        for column, definition in _ADDED_COLUMNS.items():
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE files ADD COLUMN {column} {definition}")
+        if 'ext' not in columns:
+            backfill_ext(self.conn)
+        if 'meta_len' not in columns:
+            backfill_meta_len(self.conn)
+        if 'perceptual_hash_int' not in columns and 'perceptual_hash' in columns:
+            backfill_perceptual_hash_int(self.conn)
+        # Covers per-extension counts and sizes without touching the table
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_ext ON files(ext, size)")
+        # Lets import look up the file already stored under a name in .memory
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_current_path ON files(current_path)")
+        # Lets import find managed files of a given size without a table scan
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_size ON files(size)")
+        # Partial indexes holding only files still pending upload to each target
+        for target in UPLOAD_TARGETS:
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_files_pending_{target} ON files(file_hash) WHERE uploaded_{target} = FALSE"
+            )
+        # Row count of files kept up to date by triggers, so readers don't need
+        # a full COUNT(*) scan. Seeded from the table the first time it's created.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS _counts (
+                table_name TEXT PRIMARY KEY,
+                n INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute("INSERT OR IGNORE INTO _counts (table_name, n) SELECT 'files', COUNT(*) FROM files")
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS files_count_insert AFTER INSERT ON files
+            BEGIN
+                UPDATE _counts SET n = n + 1 WHERE table_name = 'files';
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS files_count_delete AFTER DELETE ON files
+            BEGIN
+                UPDATE _counts SET n = n - 1 WHERE table_name = 'files';
+            END
+        ''')
+        # SHA-256 of files outside .memory (import sources, scanned folders),
+        # reused while a file keeps its size, mtime and inode so repeat runs only
+        # stat it. The inode catches a file replaced by another of the same size
+        # and mtime that was renamed into place (mv, rsync).
+        # Entries for files a complete walk no longer finds are pruned afterwards.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS hash_cache (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                ino INTEGER NOT NULL,
+                file_hash TEXT NOT NULL
+            )
+        ''')
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
         self.conn.commit()
 
     def add_file_metadata(self, metadata: Dict[str, Any]) -> bool:
         """Adds or updates file metadata. Returns True if added/updated, False if duplicate."""
         cursor = self.conn.cursor()
         try:
-            # Compress metadata if present
-            meta_blob = None
-            if metadata.get('extracted_metadata'):
-                meta_blob = gzip.compress(metadata['extracted_metadata'].encode('utf-8'))
-            cursor.execute('''
-                INSERT INTO files (file_hash, current_filename, current_path,
-                                   size, media_type, date_added, extracted_metadata, metadata_extracted)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                metadata['file_hash'],
-                metadata['current_filename'],
-                metadata['current_path'],
-                metadata['size'],
-                metadata['media_type'],
-                metadata['date_added'],
-                meta_blob,
-                metadata.get('metadata_extracted', False)
-            ))
+            cursor.execute(_INSERT_FILE_SQL, _file_metadata_params(metadata))
             self.conn.commit()
             return True
         except sqlite3.IntegrityError:
             # This means file_hash already exists, it's a duplicate
             return False
 
+    def add_file_metadata_many(self, rows: List[Dict[str, Any]]) -> int:
+        """
+        Adds many files in a single transaction (one commit instead of one per file).
+        Duplicates are skipped. Returns the number of rows actually added.
+        """
+        if not rows:
+            return 0
+        with self._lock, self.conn:
+            cursor = self.conn.executemany(
+                _INSERT_FILE_OR_IGNORE_SQL,
+                [_file_metadata_params(metadata) for metadata in rows]
+            )
+        return cursor.rowcount
+
     def get_file_by_hash(self, file_hash: str) -> Dict[str, Any] | None:
         """Retrieves file metadata by hash."""
         cursor = self.conn.cursor()
         cursor.execute("SELECT * FROM files WHERE file_hash = ?", (file_hash,))
         row = cursor.fetchone()
         if row:
-            result = dict(row)
-            # Decompress metadata if present
-            if result.get('extracted_metadata'):
-                try:
-                    result['extracted_metadata'] = gzip.decompress(result['extracted_metadata']).decode('utf-8')
-                except Exception:
-                    result['extracted_metadata'] = None
-            return result
+            return _row_to_dict(row)
         return None
 
-    def get_all_file_hashes(self) -> List[str]:
-        """Returns a list of all managed file hashes."""
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT file_hash FROM files")
-        return [row[0] for row in cursor.fetchall()]
+    def has_hash(self, file_hash: str) -> bool:
+        """Checks whether a file hash is already managed. Safe to call from worker threads."""
+        with self._lock:
+            cursor = self.conn.execute(_HAS_HASH_SQL, (file_hash,))
+            return cursor.fetchone() is not None
+
+    def has_size(self, size: int) -> bool:
+        """Checks whether any managed file has the given size. Safe to call from worker threads."""
+        with self._lock:
+            return self.conn.execute(_HAS_SIZE_SQL, (size,)).fetchone() is not None
+
+    def get_hash_by_current_path(self, current_path: str) -> str | None:
+        """Returns the hash of the managed file stored at current_path, if any. Safe to call from worker threads."""
+        with self._lock:
+            row = self.conn.execute(_HASH_BY_CURRENT_PATH_SQL, (current_path,)).fetchone()
+            return row[0] if row else None
+
+    def get_cached_hash(self, path: str, mtime_ns: int, size: int, ino: int) -> str | None:
+        """Returns the hash cached for path if the file still has this mtime, size and inode. Safe to call from worker threads."""
+        with self._lock:
+            row = self.conn.execute(_CACHED_HASH_SQL, (path, mtime_ns, size, ino)).fetchone()
+            return row[0] if row else None
+
+    def cache_hashes(self, entries: List[Tuple[str, int, int, str]]):
+        """Records (path, mtime_ns, size, ino, file_hash) entries in hash_cache in a single transaction."""
+        if not entries:
+            return
+        with self._lock, self.conn:
+            self.conn.executemany(_CACHE_HASH_SQL, entries)
+
+    def prune_hash_cache(self, root: str, seen_paths: set, recursive: bool = True, name_filter=None) -> int:
+        """
+        Drops hash_cache entries under root whose path isn't in seen_paths,
+        i.e. files that were deleted, moved or skipped since they were hashed.
+        Call it after a complete walk of root; a non-recursive walk only
+        prunes root's direct children, and a walk that only looked at names
+        name_filter accepts only prunes those. Returns the number of entries removed.
+        """
+        prefix = root if root.endswith(os.sep) else root + os.sep
+        # Every path starting with prefix sorts between these two bounds, so
+        # the primary key index covers the range
+        upper = prefix[:-1] + chr(ord(os.sep) + 1)
+        with self._lock:
+            stale = [
+                (path,) for path, in self.conn.execute(
+                    "SELECT path FROM hash_cache WHERE path >= ? AND path < ?", (prefix, upper))
+                if path not in seen_paths and (recursive or os.sep not in path[len(prefix):])
+                and (name_filter is None or name_filter(os.path.basename(path)))
+            ]
+            if stale:
+                with self.conn:
+                    self.conn.executemany("DELETE FROM hash_cache WHERE path = ?", stale)
+        return len(stale)
 
     def get_unuploaded_files(self, cloud_target: str = None) -> List[Dict[str, Any]]:
         """
         Retrieves files not yet uploaded to a specific cloud target or any cloud.
+        Each condition matches one of the idx_files_pending_* partial indexes, so
+        only pending files are visited. For any cloud the three index scans are
+        combined with UNION rather than OR, which SQLite can't serve from them.
         """
         cursor = self.conn.cursor()
-        query = "SELECT * FROM files WHERE "
-        if cloud_target == "s3":
-            query += "uploaded_s3 = FALSE"
-        elif cloud_target == "gcloud":
-            query += "uploaded_gcloud = FALSE"
-        elif cloud_target == "azure":
-            query += "uploaded_azure = FALSE"
+        if cloud_target in UPLOAD_TARGETS:
+            query = f"SELECT * FROM files WHERE uploaded_{cloud_target} = FALSE"
         else: # For --dryrun, list all unuploaded to *any* cloud
-            query += "uploaded_s3 = FALSE OR uploaded_gcloud = FALSE OR uploaded_azure = FALSE"
+            pending = " UNION ".join(
+                f"SELECT file_hash FROM files WHERE uploaded_{target} = FALSE" for target in UPLOAD_TARGETS
+            )
+            query = f"SELECT * FROM files WHERE file_hash IN ({pending})"
         
         cursor.execute(query)
-        results = []
-        for row in cursor.fetchall():
-            result = dict(row)
-            if result.get('extracted_metadata'):
-                try:
-                    result['extracted_metadata'] = gzip.decompress(result['extracted_metadata']).decode('utf-8')
-                except Exception:
-                    result['extracted_metadata'] = None
-            results.append(result)
-        return results
+        return [_row_to_dict(row) for row in cursor.fetchall()]
 
     def mark_uploaded(self, file_hash: str, cloud_target: str):
         """Marks a file as uploaded to a specific cloud target."""
-        cursor = self.conn.cursor()
-        if cloud_target == "s3":
-            cursor.execute("UPDATE files SET uploaded_s3 = TRUE WHERE file_hash = ?", (file_hash,))
-        elif cloud_target == "gcloud":
-            cursor.execute("UPDATE files SET uploaded_gcloud = TRUE WHERE file_hash = ?", (file_hash,))
-        elif cloud_target == "azure":
-            cursor.execute("UPDATE files SET uploaded_azure = TRUE WHERE file_hash = ?", (file_hash,))
+        if cloud_target not in _MARK_UPLOADED_SQL:
+            return
+        self.conn.execute(_MARK_UPLOADED_SQL[cloud_target], (file_hash,))
         self.conn.commit()
+
+    def mark_uploaded_many(self, file_hashes: List[str], cloud_target: str):
+        """Marks many files as uploaded to a cloud target in a single transaction."""
+        if cloud_target not in _MARK_UPLOADED_SQL or not file_hashes:
+            return
+        with self._lock, self.conn:
+            self.conn.executemany(_MARK_UPLOADED_SQL[cloud_target], [(file_hash,) for file_hash in file_hashes])
+
+# Connections shared by everything running in this process, keyed by
+# (pid, database path) so a forked child never reuses its parent's connection
+_shared_dbs: Dict[Tuple[int, str], MemoryDB] = {}
+_shared_dbs_lock = threading.Lock()
+
+def get_db(db_path: Path) -> MemoryDB:
+    """
+    Returns a connected MemoryDB for db_path that is shared across the process.
+    Commands that call each other (e.g. migrate) reuse one connection instead of
+    reopening the database and re-running the schema setup every time.
+    Any transaction left open by a previous user is rolled back first, as
+    closing the connection used to do.
+    """
+    key = (os.getpid(), str(Path(db_path).resolve()))
+    with _shared_dbs_lock:
+        db = _shared_dbs.get(key)
+        if db is None:
+            db = MemoryDB(db_path)
+            db.connect()
+            _shared_dbs[key] = db
+        elif db.conn.in_transaction:
+            db.conn.rollback()
+        return db
+
+def close_db(db_path: Path = None):
+    """Closes the shared connection for db_path, or all of them. Needed before deleting the database."""
+    with _shared_dbs_lock:
+        for key in list(_shared_dbs):
+            if key[0] == os.getpid() and (db_path is None or key[1] == str(Path(db_path).resolve())):
+                _shared_dbs.pop(key).close()
+
+atexit.register(close_db)
@@ -1,9 +1,23 @@
 from pathlib import Path
-from memory.utils import get_file_hash
+from memory.utils import get_file_hash, blake3
 
 def calculate_file_hash(filepath: Path) -> str:
     """
     Calculates the SHA256 hash of a file.
-    This implementation is pure Python.
+    hashlib's SHA256 comes from OpenSSL, which uses the CPU's SHA extensions
+    (SHA-NI / ARMv8 SHA2) when present. The algorithm is fixed because
+    file_hash is the stored identity of every managed file; switching to
+    e.g. blake3 would make every existing record look new.
     """
     return get_file_hash(filepath, algorithm='sha256')
+
+def files_have_same_content(a: Path, b: Path) -> bool:
+    """
+    Checks whether two files have identical content.
+    The digests are only compared, never stored, so blake3 (SIMD, and
+    multithreaded on large files) is used when the optional package is installed.
+    """
+    if a.stat().st_size != b.stat().st_size:
+        return False
+    algorithm = 'blake3' if blake3 is not None else 'sha256'
+    return get_file_hash(a, algorithm) == get_file_hash(b, algorithm)
@@ -1,12 +1,24 @@
 # memory/media.py
 import json
+import math
 from pathlib import Path
 from PIL import Image, UnidentifiedImageError # type: ignore
-from typing import Dict, Any
+from PIL.ExifTags import TAGS, IFD # type: ignore
+from typing import Dict, Any, Tuple
+
+try:
+    import orjson # Optional, much faster JSON encoding
+except ImportError:
+    orjson = None
 
 # Define a helper to convert non-JSON serializable types
 def _json_serializable_value(value):
-    """Converts a value to a JSON-serializable type."""
+    """
+    Converts a value to a JSON-serializable type, recursing into dicts, lists
+    and tuples. Both encoders get the result, so the stored JSON doesn't
+    depend on whether orjson is installed: non-finite floats become None
+    (orjson would write null, json NaN) and dict keys become strings.
+    """
     try:
         from PIL.TiffImagePlugin import IFDRational
     except ImportError:
@@ -15,10 +27,14 @@ def _json_serializable_value(value):
     if IFDRational is not None and isinstance(value, IFDRational):
         try:
             # Convert IFDRational to a float
-            return float(value)
+            value = float(value)
         except ZeroDivisionError:
             # Handle cases where denominator might be zero, though rare for valid EXIF
             return 0.0
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    elif isinstance(value, int) and not isinstance(value, bool) and not -(1 << 63) <= value < (1 << 64):
+        return str(value) # orjson only encodes 64-bit integers
     elif isinstance(value, bytes):
         try:
             # Attempt to decode bytes to string (e.g., for copyright strings)
@@ -27,28 +43,44 @@ def _json_serializable_value(value):
         except UnicodeDecodeError:
             # If it's not decodeable as text, represent as a hex string
             return value.hex()
+    # Nested IFDs (GPS) come back as dicts keyed by tag number
+    elif isinstance(value, dict):
+        return {key if isinstance(key, str) else str(key): _json_serializable_value(item) for key, item in value.items()}
     # If it's a tuple or list, iterate through it to process nested non-serializable items
     elif isinstance(value, (list, tuple)):
         return [_json_serializable_value(item) for item in value]
     # For any other complex object that json.dumps might struggle with, convert to string as a fallback
     # This is a generic fallback, more specific handling is better if known types emerge
-    elif not isinstance(value, (str, int, float, bool, type(None), dict, list)):
+    elif not isinstance(value, (str, int, bool, type(None))):
         return str(value) # Convert unknown types to string
     return value
 
+# Tags left out of extracted metadata: MakerNote (0x927C) is an opaque vendor
+# blob, often kilobytes, that only turns into noise once made JSON-safe
+_SKIPPED_EXIF_TAGS = frozenset({0x927C})
+
 def extract_image_metadata(filepath: Path) -> Dict[str, Any]:
-    """Extracts basic EXIF metadata from an image using Pillow."""
+    """
+    Extracts basic EXIF metadata from an image using Pillow.
+    Values are returned as Pillow decodes them; they're made JSON-safe when serialized.
+    """
     metadata = {}
     try:
         with Image.open(filepath) as img:
-            if hasattr(img, '_getexif'):
-                exif_data = img._getexif()
-                if exif_data:
-                    from PIL.ExifTags import TAGS
-                    for tag, value in exif_data.items():
-                        decoded = TAGS.get(tag, tag)
-                        # Process value to ensure it's JSON serializable
-                        metadata[decoded] = _json_serializable_value(value)
+            exif = img.getexif()
+            if exif:
+                # Top-level tags plus the Exif sub-IFD (capture date, exposure, ...)
+                # and GPS, which is what the private _getexif() merged together.
+                # Only the IFDs asked for are decoded.
+                exif_data = dict(exif)
+                exif_data.update(exif.get_ifd(IFD.Exif))
+                if IFD.GPSInfo in exif:
+                    exif_data[IFD.GPSInfo] = exif.get_ifd(IFD.GPSInfo)
+                for tag, value in exif_data.items():
+                    if tag in _SKIPPED_EXIF_TAGS:
+                        continue
+                    decoded = TAGS.get(tag, tag)
+                    metadata[decoded] = value
     except UnidentifiedImageError:
         # File is not a recognized image format or is corrupted
         pass
@@ -64,14 +96,34 @@ def extract_video_metadata(filepath: Path, logger=None) -> Dict[str, Any]:
         logger.info(f"Note: Basic video metadata extraction for {filepath} is a placeholder.")
     return {}
 
-def get_media_metadata(filepath: Path, media_type: str, logger=None) -> str:
-    """Extracts metadata based on media type and returns it as a JSON string."""
+def extract_media_metadata(filepath: Path, media_type: str, logger=None) -> Tuple[str, bool]:
+    """
+    Extracts metadata based on media type.
+    Returns the JSON string and whether any metadata was found, so callers
+    don't have to parse the JSON again to find out.
+    """
     metadata = {}
     if media_type == "photo":
         metadata = extract_image_metadata(filepath)
     elif media_type == "video":
         metadata = extract_video_metadata(filepath, logger)
     
-    # The default=str fallback is a safety net for any types _json_serializable_value misses.
-    # ensure_ascii=False allows non-ASCII characters directly in the JSON string for better readability.
-    return json.dumps(metadata, ensure_ascii=False, default=str)
\ No newline at end of file
+    # Converted up front for either encoder, so both see the same plain values
+    found = bool(metadata)
+    metadata = _json_serializable_value(metadata)
+    return _encode_metadata_json(metadata), found
+
+def _encode_metadata_json(metadata: Dict[str, Any], use_orjson: bool = orjson is not None) -> str:
+    """
+    Encodes already JSON-safe metadata compactly, with orjson when it's
+    installed. Both encoders write non-ASCII characters as is and use no
+    whitespace, so they produce the same text; only floats that need an
+    exponent may be spelled differently (3.125e-05 vs 0.00003125).
+    """
+    if use_orjson:
+        return orjson.dumps(metadata).decode('utf-8')
+    return json.dumps(metadata, ensure_ascii=False, separators=(',', ':'))
+
+def get_media_metadata(filepath: Path, media_type: str, logger=None) -> str:
+    """Extracts metadata based on media type and returns it as a JSON string."""
+    return extract_media_metadata(filepath, media_type, logger)[0]
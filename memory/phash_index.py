@@ -0,0 +1,83 @@
+from typing import Any, Dict, List, Tuple
+
+class BKTree:
+    """
+    BK-tree over 64-bit perceptual hashes using Hamming distance.
+    Every node keeps its children keyed by their distance to the node, so by the
+    triangle inequality a query within max_dist only has to descend into children
+    whose key is within max_dist of the query's own distance to that node. This
+    avoids comparing every hash against every other hash.
+    """
+    def __init__(self):
+        self._root = None # [hash, item, {distance: child node}]
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def insert(self, h: int, item: Any):
+        """Adds a hash with an associated item (e.g. a row index)."""
+        node = [h, item, {}]
+        self._size += 1
+        if self._root is None:
+            self._root = node
+            return
+        current = self._root
+        while True:
+            distance = (current[0] ^ h).bit_count()
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def find(self, h: int, max_dist: int) -> List[Tuple[int, Any]]:
+        """Returns (distance, item) for every stored hash within max_dist of h."""
+        results = []
+        if self._root is None:
+            return results
+        stack = [self._root]
+        while stack:
+            node_hash, item, children = stack.pop()
+            distance = (node_hash ^ h).bit_count()
+            if distance <= max_dist:
+                results.append((distance, item))
+            low, high = distance - max_dist, distance + max_dist
+            for child_distance, child in children.items():
+                if low <= child_distance <= high:
+                    stack.append(child)
+        return results
+
+class DisjointSet:
+    """
+    Union-find over the integers 0..n-1, with path compression and union by rank.
+    Used to turn pairwise "similar" links into groups (their transitive closure).
+    """
+    def __init__(self, n: int):
+        self._parent = list(range(n))
+        self._rank = [0] * n
+
+    def find(self, x: int) -> int:
+        root = x
+        while self._parent[root] != root:
+            root = self._parent[root]
+        while self._parent[x] != root:
+            self._parent[x], x = root, self._parent[x]
+        return root
+
+    def union(self, a: int, b: int):
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return
+        if self._rank[ra] < self._rank[rb]:
+            ra, rb = rb, ra
+        self._parent[rb] = ra
+        if self._rank[ra] == self._rank[rb]:
+            self._rank[ra] += 1
+
+    def groups(self) -> List[List[int]]:
+        """Returns every set with more than one member, each in ascending order, ordered by smallest member."""
+        by_root: Dict[int, List[int]] = {}
+        for x in range(len(self._parent)):
+            by_root.setdefault(self.find(x), []).append(x)
+        return [members for members in by_root.values() if len(members) > 1]
@@ -1,33 +1,272 @@
 import datetime
+import errno
 import hashlib
+import mmap
+import os
+import shutil
+import sys
+import time
 from pathlib import Path
 
+try:
+    import blake3 # Optional, SIMD accelerated hashing
+except ImportError:
+    blake3 = None
+
 def generate_timestamp_suffix():
     """Generates a readable timestamp suffix for filenames."""
     return datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 
-def get_file_hash(filepath: Path, algorithm: str = 'sha256', buffer_size: int = 65536) -> str:
+def iter_files(root, skip_dirs: frozenset = frozenset(), recursive: bool = True, name_filter=None,
+               skip_paths: frozenset = frozenset()):
+    """
+    Yields (path, stat) for every file under root, using os.scandir.
+    Entries know their type from the directory listing and the stat is taken
+    from the entry, so each file costs a single stat call. Directories whose
+    name is in skip_dirs, or whose path (as a str joined onto root) is in
+    skip_paths, are not entered; symlinked directories aren't followed.
+    Files whose name name_filter rejects are dropped before any Path or stat
+    is made for them. Subdirectories that can't be read, and files that vanish
+    before they are stat'ed, are skipped, like os.walk does.
+    Directories are walked from an explicit stack, so depth isn't bounded by
+    the recursion limit.
+    """
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            it = os.scandir(directory)
+        except OSError:
+            if directory is root:
+                raise
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive and entry.name not in skip_dirs and entry.path not in skip_paths:
+                            stack.append(entry.path)
+                        continue
+                    if not entry.is_file() or (name_filter is not None and not name_filter(entry.name)):
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue # Vanished or can't be stat'ed
+                yield Path(entry.path), st
+
+# Files at least this big are hashed by blake3 on several threads; below it
+# the thread pool costs more than it saves
+BLAKE3_THREADED_MIN_SIZE = 128 * 1024
+
+# Files at least this big are memory-mapped for hashing; smaller ones take a
+# read or two, cheaper than setting up and tearing down a mapping
+MMAP_HASH_MIN_SIZE = 1 << 20
+
+def _advise_sequential(fd: int):
+    """Tells the kernel the whole file will be read front to back, so it reads ahead more aggressively."""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass # Only a hint
+
+def get_file_hash(filepath: Path, algorithm: str = 'sha256', buffer_size: int = 1 << 20) -> str:
     """
     Calculates the hash of a file.
+    Large files are memory-mapped and hashed in a single update, so there is no
+    per-chunk Python overhead and hashlib releases the GIL for the whole file.
+    Smaller ones go through hashlib.file_digest (Python 3.11+), which reads
+    into a reusable buffer in C, or the same readinto loop in Python on older ones.
     """
-    h = hashlib.new(algorithm)
+    if algorithm == 'blake3':
+        if blake3 is None:
+            raise ValueError("blake3 hashing requires the 'blake3' package (pip install memory-cli[fast])")
+        threaded = os.stat(filepath).st_size >= BLAKE3_THREADED_MIN_SIZE
+        h = blake3.blake3(max_threads=blake3.blake3.AUTO if threaded else 1)
+        h.update_mmap(str(filepath))
+        return h.hexdigest()
     with open(filepath, 'rb') as f:
-        while chunk := f.read(buffer_size):
-            h.update(chunk)
+        _advise_sequential(f.fileno())
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_HASH_MIN_SIZE:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    h = hashlib.new(algorithm)
+                    h.update(mm)
+                    return h.hexdigest()
+            except (ValueError, OSError):
+                pass # Some special/network files can't be mapped
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, algorithm).hexdigest()
+        # Read into one reused buffer rather than allocating a bytes object per
+        # chunk; large chunks mean fewer calls, but no bigger than the file needs
+        h = hashlib.new(algorithm)
+        buf = bytearray(max(1, min(buffer_size, size + 1)))
+        view = memoryview(buf)
+        while n := f.readinto(buf):
+            h.update(view[:n])
     return h.hexdigest()
 
+PROGRESS_INTERVAL = 0.1 # Seconds between progress line updates
+
+class BatchedOutput:
+    """
+    Writes lines to stdout in batches rather than with one write (and stream lock) per line.
+    When stdout is a terminal each line is written straight away, so progress stays live.
+    """
+    def __init__(self, batch_size: int = 128, stream=None):
+        self._stream = stream if stream is not None else sys.stdout
+        isatty = getattr(self._stream, 'isatty', None)
+        self._interactive = bool(isatty and isatty())
+        self._batch_size = batch_size
+        self._buffer = []
+        self._last_progress = 0.0
+
+    def progress(self, text: str, final: bool = False):
+        """
+        Shows a progress line that is overwritten in place. Only on terminals,
+        and at most every PROGRESS_INTERVAL seconds unless final is set.
+        """
+        if not self._interactive:
+            return
+        now = time.monotonic()
+        if not final and now - self._last_progress < PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        self._stream.write(text + '\r')
+        self._stream.flush()
+
+    def clear_progress(self):
+        """Blanks out the progress line."""
+        if self._interactive:
+            self._stream.write(' ' * 60 + '\r')
+            self._stream.flush()
+
+    def write(self, text: str, end: str = '\n'):
+        if self._interactive:
+            self._stream.write(text + end)
+            self._stream.flush()
+            return
+        self._buffer.append(text + end)
+        if len(self._buffer) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._stream.write(''.join(self._buffer))
+            self._buffer.clear()
+        self._stream.flush()
+
+# Errors from the in-kernel copiers (copy_file_range, sendfile) meaning "not
+# possible here", rather than a real I/O failure
+_KERNEL_COPY_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.EPERM}
+
+def _sendfile_chunk(src_fd: int, dst_fd: int, count: int) -> int:
+    return os.sendfile(dst_fd, src_fd, None, count)
+
+# In-kernel ways to copy file data, tried in order. copy_file_range can clone
+# extents but older kernels refuse it across filesystems, where sendfile
+# (file to file since Linux 2.6.33) still avoids the user space round trip.
+_KERNEL_COPIERS = []
+if hasattr(os, 'copy_file_range'):
+    _KERNEL_COPIERS.append(os.copy_file_range)
+if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+    _KERNEL_COPIERS.append(_sendfile_chunk)
+
+def _kernel_copy(copy_chunk, src: Path, dst: Path) -> bool:
+    """
+    Copies the data of src into dst with copy_chunk(src_fd, dst_fd, count), which returns the bytes copied.
+    Returns False if copy_chunk stopped short of src's size (some filesystems
+    report 0 bytes copied instead of an error); dst is then incomplete.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            copied = copy_chunk(fsrc.fileno(), fdst.fileno(), remaining)
+            if copied == 0:
+                return False
+            remaining -= copied
+    return True
+
+def fast_copy(src: Path, dst: Path):
+    """
+    Copies src to dst with its metadata, like shutil.copy2.
+    On Linux the data is copied with os.copy_file_range, which never passes
+    through user space and on filesystems that support it (btrfs, XFS, ...)
+    clones extents instead of copying them. When the kernel refuses, it tries
+    os.sendfile, then falls back to shutil.copy2 (also used on other platforms).
+    """
+    for copy_chunk in _KERNEL_COPIERS:
+        try:
+            complete = _kernel_copy(copy_chunk, src, dst)
+        except OSError as e:
+            if e.errno not in _KERNEL_COPY_UNSUPPORTED:
+                raise
+            continue
+        if not complete:
+            continue # Short copy, treated like a refusal; dst is rewritten below
+        shutil.copystat(src, dst)
+        return
+    shutil.copy2(src, dst)
+
+# Known media file extensions (lowercase, with leading dot). Extend as needed.
+PHOTO_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp'})
+VIDEO_EXTENSIONS = frozenset({'.mp4', '.mov', '.avi', '.mkv', '.webm', '.flv'})
+_MEDIA_TYPE_BY_EXT = {
+    **{ext: "photo" for ext in PHOTO_EXTENSIONS},
+    **{ext: "video" for ext in VIDEO_EXTENSIONS},
+}
+
 def get_media_type(filepath: Path) -> str | None:
     """
     Determines if a file is a known media type (photo/video).
-    Extend this list as needed.
+    A single dict lookup on the lowercased suffix, as it runs for every scanned file.
     """
-    ext = filepath.suffix.lower()
-    if ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp']:
-        return "photo"
-    elif ext in ['.mp4', '.mov', '.avi', '.mkv', '.webm', '.flv']:
-        return "video"
-    # Add other media types as needed
-    return None
+    return _MEDIA_TYPE_BY_EXT.get(filepath.suffix.lower())
+
+def get_media_type_by_name(filename: str) -> str | None:
+    """Same as get_media_type, for a bare file name (e.g. a DirEntry's) without building a Path."""
+    return _MEDIA_TYPE_BY_EXT.get(os.path.splitext(filename)[1].lower())
+
+def file_ext(filename: str) -> str:
+    """Lowercased extension of a file name without the dot, '' if it has none. Stored in the files table's ext column."""
+    return os.path.splitext(filename)[1][1:].lower()
+
+def _is_riff(form: bytes):
+    return lambda header: header.startswith(b'RIFF') and header[8:12] == form
+
+def _is_ebml(header: bytes) -> bool:
+    # MKV files start with an EBML header; WebM is a subset of MKV
+    return header.startswith(b'\x1a\x45\xdf\xa3')
+
+# Header check for each known extension, given the file's first 16 bytes.
+# Looked up once per file instead of walking a chain of extension compares.
+_HEADER_CHECKS = {
+    # JPEG
+    '.jpg': lambda header: header.startswith(b'\xff\xd8\xff'),
+    '.jpeg': lambda header: header.startswith(b'\xff\xd8\xff'),
+    # PNG
+    '.png': lambda header: header.startswith(b'\x89PNG\r\n\x1a\n'),
+    # GIF
+    '.gif': lambda header: header.startswith((b'GIF87a', b'GIF89a')),
+    # BMP
+    '.bmp': lambda header: header.startswith(b'BM'),
+    # TIFF
+    '.tiff': lambda header: header.startswith((b'II*\x00', b'MM\x00*')),
+    # WebP
+    '.webp': _is_riff(b'WEBP'),
+    # MP4 files start with ftyp box
+    '.mp4': lambda header: len(header) >= 8 and header[4:8] == b'ftyp',
+    # MOV (QuickTime) files can start with ftyp or moov
+    '.mov': lambda header: len(header) >= 8 and header[4:8] in (b'ftyp', b'moov'),
+    # AVI
+    '.avi': _is_riff(b'AVI '),
+    # MKV / WebM
+    '.mkv': _is_ebml,
+    '.webm': _is_ebml,
+    # FLV
+    '.flv': lambda header: header.startswith(b'FLV'),
+}
 
 def is_valid_media_file(filepath: Path) -> bool:
     """
@@ -35,66 +274,16 @@ def is_valid_media_file(filepath: Path) -> bool:
     Returns True if the file appears to be a valid media file, False otherwise.
     """
     try:
-        with open(filepath, 'rb') as f:
-            header = f.read(16)  # Read first 16 bytes
-            
-        ext = filepath.suffix.lower()
-        
-        # JPEG
-        if ext in ['.jpg', '.jpeg']:
-            return header.startswith(b'\xff\xd8\xff')
-        
-        # PNG
-        elif ext == '.png':
-            return header.startswith(b'\x89PNG\r\n\x1a\n')
-        
-        # GIF
-        elif ext == '.gif':
-            return header.startswith(b'GIF87a') or header.startswith(b'GIF89a')
-        
-        # BMP
-        elif ext == '.bmp':
-            return header.startswith(b'BM')
-        
-        # TIFF
-        elif ext == '.tiff':
-            return header.startswith(b'II*\x00') or header.startswith(b'MM\x00*')
-        
-        # WebP
-        elif ext == '.webp':
-            return header.startswith(b'RIFF') and header[8:12] == b'WEBP'
-        
-        # MP4
-        elif ext == '.mp4':
-            # MP4 files start with ftyp box
-            return len(header) >= 8 and header[4:8] == b'ftyp'
-        
-        # MOV (QuickTime)
-        elif ext == '.mov':
-            # MOV files can start with ftyp or moov
-            return len(header) >= 8 and (header[4:8] == b'ftyp' or header[4:8] == b'moov')
-        
-        # AVI
-        elif ext == '.avi':
-            return header.startswith(b'RIFF') and header[8:12] == b'AVI '
-        
-        # MKV
-        elif ext == '.mkv':
-            # MKV files start with EBML header
-            return header.startswith(b'\x1a\x45\xdf\xa3')
-        
-        # WebM
-        elif ext == '.webm':
-            # WebM is a subset of MKV
-            return header.startswith(b'\x1a\x45\xdf\xa3')
-        
-        # FLV
-        elif ext == '.flv':
-            return header.startswith(b'FLV')
-        
-        # Unknown format
-        else:
-            return True  # Assume valid if we don't know the format
-            
+        # A raw descriptor: open() would set up a buffered reader and read a
+        # whole buffer's worth (8 KiB) just to return the first 16 bytes
+        fd = os.open(filepath, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            header = os.read(fd, 16)  # Read first 16 bytes
+        finally:
+            os.close(fd)
     except Exception:
         return False  # File can't be read or other error
+    check = _HEADER_CHECKS.get(filepath.suffix.lower())
+    if check is None:
+        return True  # Assume valid if we don't know the format
+    return check(header)
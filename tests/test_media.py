@@ -0,0 +1,58 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from PIL import Image
+from PIL.ExifTags import IFD
+from PIL.TiffImagePlugin import IFDRational
+
+from memory import media
+
+
+@unittest.skipIf(media.orjson is None, "orjson is not installed")
+class MetadataEncodingTest(unittest.TestCase):
+    """The stored metadata must not depend on whether orjson is installed."""
+
+    def _extract(self, exif) -> dict:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'photo.jpg'
+            Image.new('RGB', (8, 8)).save(path, exif=exif)
+            return media._json_serializable_value(media.extract_image_metadata(path))
+
+    def test_encoders_agree_on_exif(self):
+        exif = Image.Exif()
+        exif[0x010F] = 'Caméra'  # Make, non-ASCII
+        exif[0x0131] = 'editor'  # Software
+        exif.get_ifd(IFD.Exif)[0x829D] = IFDRational(28, 10)  # FNumber
+        exif.get_ifd(IFD.Exif)[0x9204] = IFDRational(1, 0)  # ExposureBiasValue, NaN
+        exif.get_ifd(IFD.GPSInfo)[2] = (IFDRational(52, 1), IFDRational(30, 1), IFDRational(1234, 100))
+        exif.get_ifd(IFD.GPSInfo)[1] = 'N'
+        metadata = self._extract(exif)
+        self.assertEqual(metadata['GPSInfo']['2'], [52.0, 30.0, 12.34])
+        self.assertIsNone(metadata['ExposureBiasValue'])
+        self.assertEqual(
+            media._encode_metadata_json(metadata, use_orjson=True),
+            media._encode_metadata_json(metadata, use_orjson=False),
+        )
+
+    def test_encoders_agree_on_values(self):
+        metadata = media._json_serializable_value({
+            'nested': {1: [float('nan'), float('inf'), b'\xff\x00', (1, 2)]},
+            'big': 1 << 70,
+            'text': 'line\nbreak é ☃',
+            'tiny': 3.125e-05,
+        })
+        from_orjson = media._encode_metadata_json(metadata, use_orjson=True)
+        from_json = media._encode_metadata_json(metadata, use_orjson=False)
+        # Floats that need an exponent are spelled differently, nothing else is
+        self.assertEqual(json.loads(from_orjson), json.loads(from_json))
+        del metadata['tiny']
+        self.assertEqual(
+            media._encode_metadata_json(metadata, use_orjson=True),
+            media._encode_metadata_json(metadata, use_orjson=False),
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()